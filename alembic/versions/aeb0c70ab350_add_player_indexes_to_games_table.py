@@ -0,0 +1,38 @@
+"""Add player indexes to games table
+
+Revision ID: aeb0c70ab350
+Revises: 7a3a9480b443
+Create Date: 2026-10-18 11:02:17.530214
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'aeb0c70ab350'
+down_revision = '7a3a9480b443'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # built concurrently so that a large games table stays writable, which cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('ix_games_white_player_history', 'games',
+                        ['white_player_id', 'is_concluded', sa.text('created_at DESC')],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_games_black_player_history', 'games',
+                        ['black_player_id', 'is_concluded', sa.text('created_at DESC')],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_games_active_white_player', 'games', ['white_player_id'], unique=False,
+                        postgresql_where=sa.text('NOT is_concluded'), postgresql_concurrently=True)
+        op.create_index('ix_games_active_black_player', 'games', ['black_player_id'], unique=False,
+                        postgresql_where=sa.text('NOT is_concluded'), postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_games_active_black_player', table_name='games')
+    op.drop_index('ix_games_active_white_player', table_name='games')
+    op.drop_index('ix_games_black_player_history', table_name='games')
+    op.drop_index('ix_games_white_player_history', table_name='games')
@@ -0,0 +1,67 @@
+import argparse
+import json
+import random
+import sys
+import timeit
+
+import orjson
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+
+from . import moves, schemas
+
+START = "rnbqkbnr#pppppppp#8#8#8#8#PPPPPPPP#RNBQKBNR"
+
+
+# a game of random legal moves, as the players receive it after every move of a long game
+def game_payload(plies: int = 80, seed: int = 1):
+    state = {
+        "id": 1, "board": START, "active_player": "w", "last_move_start": [], "last_move_end": [],
+        "moves": [], "move_history": [], "steps": [], "white_king_pos": [0, 4], "black_king_pos": [7, 4],
+        "enpassant_position": [], "castle_eligibility": [True] * 4, "checked_king": None,
+        "is_concluded": False, "winner": None, "end_reason": None, "draw": None,
+        "Capture": {piece: 0 for piece in moves.CAPTURE_PIECES},
+    }
+    moves.track_positions(state, [])
+    rng = random.Random(seed)
+    while len(state["move_history"]) < plies and not state["is_concluded"]:
+        move = rng.choice(moves.position_of(state).legal_moves())
+        player_color = state["active_player"]
+        moves.apply_delta(state, {
+            "start": moves.coordinates(move & 63),
+            "end": moves.coordinates(move >> 6 & 63),
+            "promotion": "_nbrq"[move >> 12] if move >> 12 else None,
+        }, player_color)
+    return schemas.GameMoveOut(**moves.snapshot(state, "w"))
+
+
+def measure(function, number: int):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare json and orjson on a game snapshot message")
+    parser.add_argument("--plies", type=int, default=80, help="moves played in the game")
+    parser.add_argument("-n", "--number", type=int, default=2000, help="runs of each case")
+    args = parser.parse_args(argv)
+
+    game = game_payload(args.plies)
+    data = game.dict()
+    text = json.dumps(data)
+    # what fastapi hands the response class after validating the response model
+    content = jsonable_encoder(game)
+    cases = [
+        ("encode socket message", lambda: json.dumps(data), lambda: orjson.dumps(data).decode()),
+        ("decode socket message", lambda: json.loads(text), lambda: orjson.loads(text)),
+        ("render response", lambda: JSONResponse(content), lambda: ORJSONResponse(content)),
+    ]
+    print(f"{len(game.move_history)} moves, {len(text)} bytes")
+    print(f"{'case':<24}{'json us':>10}{'orjson us':>12}{'speedup':>10}")
+    for name, stdlib, fast in cases:
+        slow_us, fast_us = measure(stdlib, args.number), measure(fast, args.number)
+        print(f"{name:<24}{slow_us:>10.1f}{fast_us:>12.1f}{slow_us / fast_us:>9.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+import asyncio
+import logging
+import uuid
+
+import orjson
+import psycopg2
+import psycopg2.extensions
+
+from .config import settings
+from .database import SQLALCHEMY_DATABASE_URL
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[int, dict], Awaitable[None]]
+
+
+class MemoryBroadcast:
+    # relays game messages between the workers that host a game. the sender delivers to its own sockets,
+    # a backend only carries messages to the other workers.
+    # this one connects the backends of a single process, which is all there is with one worker
+
+    channels: dict[int, set["MemoryBroadcast"]] = {}
+
+    def __init__(self):
+        # id of this worker, sent with every message
+        self.origin = uuid.uuid4().hex
+        self.handler: Handler | None = None
+
+    async def start(self, handler: Handler):
+        # handler receives (game_id, message) for messages published by other workers
+        self.handler = handler
+
+    async def close(self):
+        for subscribers in self.channels.values():
+            subscribers.discard(self)
+
+    async def subscribe(self, game_id: int):
+        self.channels.setdefault(game_id, set()).add(self)
+
+    async def unsubscribe(self, game_id: int):
+        subscribers = self.channels.get(game_id, set())
+        subscribers.discard(self)
+        if not subscribers:
+            self.channels.pop(game_id, None)
+
+    async def publish(self, game_id: int, message: dict):
+        for backend in list(self.channels.get(game_id, ())):
+            if backend is not self and backend.handler:
+                await backend.handler(game_id, {**message, "origin": self.origin})
+
+
+class PostgresBroadcast(MemoryBroadcast):
+    # LISTEN/NOTIFY on one channel per game, so a worker only hears the games it hosts.
+    # commands run on a thread of their own in the order they were issued, notifications are read on the loop
+
+    # postgres refuses notify payloads of 8000 bytes or more
+    MAX_PAYLOAD = 7999
+
+    def __init__(self, dsn: str):
+        super().__init__()
+        self.dsn = dsn
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="broadcast")
+        self.connection = None
+        self.fd = -1
+        self.games: set[int] = set()
+        self.loop: asyncio.AbstractEventLoop | None = None
+        # notifications are handled one at a time, in the order they arrived
+        self.received: asyncio.Queue = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+
+    @staticmethod
+    def channel(game_id: int):
+        return f"game_{game_id}"
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self.loop = asyncio.get_running_loop()
+        await self._run(self._connect)
+        self.task = asyncio.create_task(self._deliver())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.connection:
+            self.loop.remove_reader(self.fd)
+            await self._run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown(wait=True)
+
+    async def subscribe(self, game_id: int):
+        self.games.add(game_id)
+        await self._run(self._execute, f"LISTEN {self.channel(game_id)}")
+
+    async def unsubscribe(self, game_id: int):
+        self.games.discard(game_id)
+        await self._run(self._execute, f"UNLISTEN {self.channel(game_id)}")
+
+    async def publish(self, game_id: int, message: dict):
+        payload = orjson.dumps({**message, "origin": self.origin})
+        if len(payload) > self.MAX_PAYLOAD:
+            logger.error("Message of game %s is too large to broadcast", game_id)
+            return
+        await self._run(self._execute, "SELECT pg_notify(%s, %s)", (self.channel(game_id), payload.decode()))
+
+    async def _run(self, function, *args):
+        await self.loop.run_in_executor(self.executor, function, *args)
+
+    def _connect(self):
+        if self.connection:
+            self.loop.call_soon_threadsafe(self.loop.remove_reader, self.fd)
+            self.connection.close()
+        self.connection = psycopg2.connect(self.dsn)
+        self.fd = self.connection.fileno()
+        self.connection.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with self.connection.cursor() as cursor:
+            for game_id in self.games:
+                cursor.execute(f"LISTEN {self.channel(game_id)}")
+        self.loop.call_soon_threadsafe(self.loop.add_reader, self.fd, self._notified)
+
+    # a lost connection is opened again once, listening to the same games
+    def _execute(self, query: str, params: tuple = None):
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(query, params)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logger.warning("Broadcast connection lost, reconnecting")
+            self._connect()
+            with self.connection.cursor() as cursor:
+                cursor.execute(query, params)
+
+    def _notified(self):
+        try:
+            self.connection.poll()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.loop.remove_reader(self.fd)
+            self.loop.run_in_executor(self.executor, self._connect)
+            return
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            message = orjson.loads(notify.payload)
+            # every listener hears its own notifications too
+            if message.get("origin") == self.origin:
+                continue
+            self.received.put_nowait((int(notify.channel.removeprefix("game_")), message))
+
+    async def _deliver(self):
+        while True:
+            game_id, message = await self.received.get()
+            try:
+                await self.handler(game_id, message)
+            except Exception:
+                logger.exception("Broadcast message of game %s failed", game_id)
+
+
+def create_broadcast():
+    if settings.broadcast_backend == "postgres":
+        return PostgresBroadcast(SQLALCHEMY_DATABASE_URL)
+    return MemoryBroadcast()
@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Hashable
+from threading import Lock
+import time
+
+from .journal import MoveJournal
+
+
+class GameCache:
+    # state of the live games of this worker, keyed by game id. it is filled when the first player connects
+    # and evicted when the game is over or the last socket closes. moves are applied here and written through
+    # to the database by the move journal, so neither moves nor /games/active read postgres again.
+    # states are never changed in place, a move stores a new dict, so readers on other threads always see
+    # a whole move
+
+    def __init__(self, journal: MoveJournal, loader: Callable[[int], Awaitable[tuple[dict, int] | None]]):
+        self.journal = journal
+        # loader reads a game and the number of its saved moves from the database
+        self.loader = loader
+        self.games: dict[int, dict] = {}
+        # user id -> id of the ongoing game the user plays
+        self.players: dict[int, int] = {}
+        # game id -> number of moves in the database
+        self.saved: dict[int, int] = {}
+
+    def get(self, game_id: int):
+        return self.games.get(game_id)
+
+    def for_player(self, user_id: int):
+        game_id = self.players.get(user_id)
+        return self.games.get(game_id) if game_id is not None else None
+
+    async def load(self, game_id: int):
+        state = self.games.get(game_id)
+        if state is not None:
+            return state
+        # a game still waiting in the journal is newer than the database copy
+        state = self.journal.get(game_id)
+        if state is None:
+            loaded = await self.loader(game_id)
+            if loaded is None:
+                return None
+            state, saved = loaded
+            self.saved[game_id] = saved
+        # another connection may have loaded the game meanwhile
+        if game_id in self.games:
+            return self.games[game_id]
+        self.put(game_id, state)
+        return state
+
+    def put(self, game_id: int, state: dict):
+        self.games[game_id] = state
+        if state['is_concluded']:
+            self.evict(game_id)
+            return
+        self.players[state['white_player_id']] = game_id
+        self.players[state['black_player_id']] = game_id
+
+    def evict(self, game_id: int):
+        state = self.games.pop(game_id, None)
+        self.saved.pop(game_id, None)
+        if state:
+            for user_id in (state['white_player_id'], state['black_player_id']):
+                if self.players.get(user_id) == game_id:
+                    self.players.pop(user_id)
+
+
+class TTLCache:
+    # least recently used cache whose entries also expire after ttl seconds.
+    # sync endpoints run on the threadpool, so every access takes the lock
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: OrderedDict = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: Hashable):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
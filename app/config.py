@@ -12,6 +12,65 @@ class Settings(BaseSettings):
     algorithm: str
     access_token_expire_minutes: int
     refresh_token_expire_minutes: int
+    # connection pools of each worker, one per engine (sync and async): connections kept open, extra ones
+    # opened under load, seconds to wait for a free one, seconds before a connection is replaced, whether a
+    # connection is tested before use and the statement timeout of every connection (0 for none). the web
+    # process sets a timeout in the Procfile, maintenance commands such as python -m app.stats run without one
+    db_pool_size: int = 10
+    db_max_overflow: int = 20
+    db_pool_timeout_seconds: float = 30
+    db_pool_recycle_seconds: int = 1800
+    db_pool_pre_ping: bool = True
+    db_statement_timeout_ms: int = 0
+    # read replicas as comma separated postgresql:// urls. read-only endpoints use a replica that answers and
+    # is at most replica_max_lag_seconds behind, checked every replica_check_seconds, and the primary otherwise.
+    # a replica that does not accept a connection within replica_connect_timeout_seconds counts as down
+    database_replica_urls: str = ''
+    replica_max_lag_seconds: float = 5
+    replica_check_seconds: float = 5
+    replica_connect_timeout_seconds: int = 2
+    # write-behind journal of game moves. leave the path empty to keep the journal in memory only.
+    # every worker process writes to a numbered slot next to the path, see journal.MoveJournal
+    move_journal_path: str = ''
+    move_journal_fsync: bool = False
+    move_journal_flush_ms: int = 200
+    move_journal_flush_moves: int = 100
+    # authenticated users are cached by id. with auth_user_from_token the user is read from the
+    # access token claims and the users table is not queried at all
+    user_cache_size: int = 10000
+    user_cache_ttl_seconds: int = 300
+    auth_user_from_token: bool = False
+    # refresh tokens known to be stored or not, remembered by /refresh for a short while,
+    # and how often and in which batches expired ones are deleted
+    refresh_cache_size: int = 10000
+    refresh_cache_ttl_seconds: int = 60
+    token_purge_interval_seconds: int = 3600
+    token_purge_batch: int = 1000
+    # bcrypt cost factor and the process pool hashing passwords
+    bcrypt_rounds: int = 12
+    password_workers: int = 2
+    password_queue_limit: int = 16
+    # page size of the game history
+    games_page_size: int = 100
+    games_page_max: int = 500
+    # games one bulk request can create, and the comma separated emails of the users allowed to pair other
+    # players. everyone else can only create games they play in
+    games_create_max: int = 1000
+    game_organisers: str = ''
+    # relays moves between workers: memory (a single worker) or postgres (LISTEN/NOTIFY)
+    broadcast_backend: str = 'memory'
+    # how long a worker that missed a move waits for the sending worker to save the game
+    resync_timeout_seconds: float = 5
+    # outbound messages queued per socket, what to do when the queue is full (drop, coalesce or disconnect)
+    # and how long a single write may take before the client is disconnected
+    socket_queue_size: int = 32
+    socket_backpressure: str = 'coalesce'
+    socket_send_timeout_ms: int = 5000
+    # moves of each game kept in memory for spectators joining late
+    spectator_recent_moves: int = 64
+    # page size of the available opponents
+    users_page_size: int = 50
+    users_page_max: int = 200
 
     class Config:
         env_file = '.env'
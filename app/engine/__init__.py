@@ -0,0 +1,3 @@
+from .bitboards import WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, EMPTY, square, squares_of
+from .position import Position, BOARD_LETTERS, encode_move, decode_move
+from .zobrist import to_signed, to_unsigned
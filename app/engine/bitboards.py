@@ -0,0 +1,87 @@
+# squares are numbered row * 8 + col, row 0 being white's back rank and col 0 the a file,
+# the same coordinates the games table uses for king positions and last moves
+WHITE, BLACK = 0, 1
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+EMPTY = -1
+
+FULL = (1 << 64) - 1
+ROWS = [0xFF << (8 * row) for row in range(8)]
+
+
+def square(row: int, col: int):
+    return row * 8 + col
+
+
+def lsb(bb: int):
+    return (bb & -bb).bit_length() - 1
+
+
+def msb(bb: int):
+    return bb.bit_length() - 1
+
+
+def squares_of(bb: int):
+    while bb:
+        low = bb & -bb
+        yield low.bit_length() - 1
+        bb ^= low
+
+
+def _steps(sq: int, offsets, repeat: bool):
+    row, col = divmod(sq, 8)
+    bb = 0
+    for dr, dc in offsets:
+        r, c = row + dr, col + dc
+        while 0 <= r < 8 and 0 <= c < 8:
+            bb |= 1 << square(r, c)
+            if not repeat:
+                break
+            r, c = r + dr, c + dc
+    return bb
+
+
+KNIGHT_ATTACKS = [_steps(sq, ((1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)), False)
+                  for sq in range(64)]
+KING_ATTACKS = [_steps(sq, ((1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)), False)
+                for sq in range(64)]
+# squares a pawn of the given colour standing on sq attacks
+PAWN_ATTACKS = [
+    [_steps(sq, ((1, -1), (1, 1)), False) for sq in range(64)],
+    [_steps(sq, ((-1, -1), (-1, 1)), False) for sq in range(64)],
+]
+
+# rays run from a square to the edge of the board. on rays towards higher squares the nearest
+# blocker is the lowest set bit, on the others it is the highest
+_DIRECTIONS = {
+    (1, 0): True, (0, 1): True, (1, 1): True, (1, -1): True,
+    (-1, 0): False, (0, -1): False, (-1, -1): False, (-1, 1): False,
+}
+RAYS = {direction: [_steps(sq, (direction,), True) for sq in range(64)]
+        for direction in _DIRECTIONS}
+ROOK_RAYS = [(RAYS[d], _DIRECTIONS[d]) for d in ((1, 0), (0, 1), (-1, 0), (0, -1))]
+BISHOP_RAYS = [(RAYS[d], _DIRECTIONS[d]) for d in ((1, 1), (1, -1), (-1, -1), (-1, 1))]
+
+
+def _slide(sq: int, occupied: int, rays):
+    attacks = 0
+    for ray, increasing in rays:
+        bb = ray[sq]
+        blockers = bb & occupied
+        if blockers:
+            first = ((blockers & -blockers).bit_length() if increasing else blockers.bit_length()) - 1
+            # cut the ray behind the first blocker, the blocker itself stays attacked
+            bb ^= ray[first]
+        attacks |= bb
+    return attacks
+
+
+def rook_attacks(sq: int, occupied: int):
+    return _slide(sq, occupied, ROOK_RAYS)
+
+
+def bishop_attacks(sq: int, occupied: int):
+    return _slide(sq, occupied, BISHOP_RAYS)
+
+
+def queen_attacks(sq: int, occupied: int):
+    return _slide(sq, occupied, ROOK_RAYS) | _slide(sq, occupied, BISHOP_RAYS)
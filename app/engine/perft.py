@@ -0,0 +1,78 @@
+import argparse
+import sys
+import time
+
+from .position import Position
+
+# standard perft positions with their known node counts by depth
+# https://www.chessprogramming.org/Perft_Results
+POSITIONS = {
+    "start": ("rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1",
+              [20, 400, 8902, 197281, 4865609, 119060324]),
+    "kiwipete": ("r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+                 [48, 2039, 97862, 4085603, 193690690]),
+    "position3": ("8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+                  [14, 191, 2812, 43238, 674624, 11030083]),
+    "position4": ("r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+                  [6, 264, 9467, 422333, 15833292]),
+    "position5": ("rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+                  [44, 1486, 62379, 2103487, 89941194]),
+    "position6": ("r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+                  [46, 2079, 89890, 3894594, 164075551]),
+}
+# depths that run in a few seconds each
+DEFAULT_DEPTHS = {"start": 4, "kiwipete": 3, "position3": 4, "position4": 3, "position5": 3, "position6": 3}
+
+
+def perft(position: Position, depth: int):
+    moves = position.legal_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for move in moves:
+        undo = position.make_move(move)
+        nodes += perft(position, depth - 1)
+        position.unmake_move(move, undo)
+    return nodes
+
+
+def run(name: str, fen: str, depth: int, expected: int | None, min_nps: int = 0):
+    position = Position.from_fen(fen)
+    started = time.perf_counter()
+    nodes = perft(position, depth) if depth > 0 else 1
+    elapsed = time.perf_counter() - started
+    nps = nodes / max(elapsed, 1e-9)
+    result = ""
+    if expected is not None:
+        result = "  ok" if nodes == expected else f"  FAILED, expected {expected} nodes"
+    if nps < min_nps:
+        result += f"  TOO SLOW, expected {min_nps} nodes/s"
+    print(f"{name:<10} depth {depth}  nodes {nodes:>10}  {elapsed:7.2f}s  {nps:>9.0f} nodes/s{result}")
+    return (expected is None or nodes == expected) and nps >= min_nps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Count move generator leaf nodes of the standard perft positions")
+    parser.add_argument("positions", nargs="*",
+                        help=f"positions to run, all of them by default: {', '.join(POSITIONS)}")
+    parser.add_argument("-d", "--depth", type=int, help="depth to search instead of the default one")
+    parser.add_argument("--fen", help="run a custom position instead, nothing to compare against")
+    parser.add_argument("--min-nps", type=int, default=0,
+                        help="fail when a position is searched slower than this many nodes per second")
+    args = parser.parse_args(argv)
+
+    if args.fen:
+        return 0 if run("fen", args.fen, args.depth or 3, None, args.min_nps) else 1
+    unknown = set(args.positions) - set(POSITIONS)
+    if unknown:
+        parser.error(f"unknown positions: {', '.join(sorted(unknown))}")
+    ok = True
+    for name in args.positions or POSITIONS:
+        fen, counts = POSITIONS[name]
+        depth = args.depth or DEFAULT_DEPTHS[name]
+        ok &= run(name, fen, depth, counts[depth - 1] if 0 < depth <= len(counts) else None, args.min_nps)
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+from .bitboards import (
+    WHITE, BLACK, PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING, EMPTY, ROWS,
+    KNIGHT_ATTACKS, KING_ATTACKS, PAWN_ATTACKS, rook_attacks, bishop_attacks, queen_attacks, square, squares_of,
+)
+from .zobrist import PIECE_KEYS, SIDE_KEY, CASTLING_KEYS, EP_KEYS
+
+# castling rights, in the order of the castle_eligibility column
+WHITE_QUEENSIDE, WHITE_KINGSIDE, BLACK_QUEENSIDE, BLACK_KINGSIDE = 1, 2, 4, 8
+ALL_CASTLING = 15
+
+# rights that survive a move touching the square (king or rook leaving, rook being taken)
+CASTLING_MASK = [ALL_CASTLING] * 64
+CASTLING_MASK[square(0, 4)] &= ~(WHITE_QUEENSIDE | WHITE_KINGSIDE)
+CASTLING_MASK[square(0, 0)] &= ~WHITE_QUEENSIDE
+CASTLING_MASK[square(0, 7)] &= ~WHITE_KINGSIDE
+CASTLING_MASK[square(7, 4)] &= ~(BLACK_QUEENSIDE | BLACK_KINGSIDE)
+CASTLING_MASK[square(7, 0)] &= ~BLACK_QUEENSIDE
+CASTLING_MASK[square(7, 7)] &= ~BLACK_KINGSIDE
+
+# right, king from, king to, squares that must be empty, squares the king crosses
+CASTLES = [
+    [(WHITE_KINGSIDE, 4, 6, 0x60, (5, 6)), (WHITE_QUEENSIDE, 4, 2, 0x0E, (3, 2))],
+    [(BLACK_KINGSIDE, 60, 62, 0x60 << 56, (61, 62)), (BLACK_QUEENSIDE, 60, 58, 0x0E << 56, (59, 58))],
+]
+# rook from and to, by the square the king lands on
+ROOK_CASTLE_MOVES = {6: (7, 5), 2: (0, 3), 62: (63, 61), 58: (56, 59)}
+
+# the games table writes white pieces in lower case, FEN writes them in upper case
+BOARD_LETTERS = "pnbrqkPNBRQK"
+FEN_LETTERS = "PNBRQKpnbrqk"
+PROMOTIONS = {'n': KNIGHT, 'b': BISHOP, 'r': ROOK, 'q': QUEEN}
+
+
+# a move is packed in 15 bits: from square, to square and the promotion piece (0 for none)
+def encode_move(start: int, end: int, promotion: int = 0):
+    return start | end << 6 | promotion << 12
+
+
+def decode_move(move: int):
+    return move & 63, move >> 6 & 63, move >> 12
+
+
+class Position:
+    __slots__ = ('pieces', 'occupied', 'squares', 'side', 'castling', 'ep', 'halfmove', 'fullmove', 'key')
+
+    def __init__(self):
+        # pieces[colour][kind] and occupied[colour] are bitboards, squares maps a square to colour * 6 + kind
+        self.pieces = [[0] * 6, [0] * 6]
+        self.occupied = [0, 0]
+        self.squares = [EMPTY] * 64
+        self.side = WHITE
+        self.castling = 0
+        # square a pawn can capture en passant on, -1 when there is none
+        self.ep = -1
+        self.halfmove = 0
+        self.fullmove = 1
+        # zobrist key, kept up to date by make_move and unmake_move
+        self.key = 0
+
+    def put(self, sq: int, color: int, kind: int):
+        self.pieces[color][kind] |= 1 << sq
+        self.occupied[color] |= 1 << sq
+        self.squares[sq] = color * 6 + kind
+
+    @classmethod
+    def from_board(cls, board: str, active_player: str = 'w', castle_eligibility: list[bool] = None,
+                   enpassant_position: list[int] = None):
+        position = cls()
+        for row, line in enumerate(board.split('#')):
+            col = 0
+            for char in line:
+                if char.isdigit():
+                    col += int(char)
+                    continue
+                color, kind = divmod(BOARD_LETTERS.index(char), 6)
+                position.put(square(row, col), color, kind)
+                col += 1
+        position.side = WHITE if active_player == 'w' else BLACK
+        for index, eligible in enumerate(castle_eligibility or []):
+            if eligible:
+                position.castling |= 1 << index
+        if enpassant_position:
+            position.ep = square(*enpassant_position)
+        position.key = position.compute_key()
+        return position
+
+    @classmethod
+    def from_fen(cls, fen: str):
+        placement, side, castling, ep, *counters = fen.split()
+        position = cls()
+        for rank, line in enumerate(placement.split('/')):
+            col = 0
+            for char in line:
+                if char.isdigit():
+                    col += int(char)
+                    continue
+                color, kind = divmod(FEN_LETTERS.index(char), 6)
+                position.put(square(7 - rank, col), color, kind)
+                col += 1
+        position.side = WHITE if side == 'w' else BLACK
+        for char, right in (('K', WHITE_KINGSIDE), ('Q', WHITE_QUEENSIDE), ('k', BLACK_KINGSIDE), ('q', BLACK_QUEENSIDE)):
+            if char in castling:
+                position.castling |= right
+        if ep != '-':
+            position.ep = square(int(ep[1]) - 1, ord(ep[0]) - ord('a'))
+        if counters:
+            position.halfmove, position.fullmove = int(counters[0]), int(counters[1])
+        position.key = position.compute_key()
+        return position
+
+    # the en passant square only counts when the side to move has a pawn that can take on it,
+    # otherwise the same position would get different keys
+    def _ep_key(self):
+        if self.ep >= 0 and PAWN_ATTACKS[self.side ^ 1][self.ep] & self.pieces[self.side][PAWN]:
+            return EP_KEYS[self.ep & 7]
+        return 0
+
+    def compute_key(self):
+        key = CASTLING_KEYS[self.castling] ^ self._ep_key()
+        if self.side == BLACK:
+            key ^= SIDE_KEY
+        for sq, piece in enumerate(self.squares):
+            if piece != EMPTY:
+                key ^= PIECE_KEYS[piece][sq]
+        return key
+
+    def to_board(self):
+        rows = []
+        for row in range(8):
+            line, empty = "", 0
+            for col in range(8):
+                piece = self.squares[square(row, col)]
+                if piece == EMPTY:
+                    empty += 1
+                    continue
+                if empty:
+                    line += str(empty)
+                    empty = 0
+                line += BOARD_LETTERS[piece]
+            if empty:
+                line += str(empty)
+            rows.append(line)
+        return '#'.join(rows)
+
+    def castle_eligibility(self):
+        return [bool(self.castling & 1 << index) for index in range(4)]
+
+    def king_square(self, color: int):
+        return self.pieces[color][KING].bit_length() - 1
+
+    def attacked(self, sq: int, by: int):
+        pieces = self.pieces[by]
+        if PAWN_ATTACKS[by ^ 1][sq] & pieces[PAWN] or KNIGHT_ATTACKS[sq] & pieces[KNIGHT] \
+                or KING_ATTACKS[sq] & pieces[KING]:
+            return True
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        diagonal = pieces[BISHOP] | pieces[QUEEN]
+        if diagonal and bishop_attacks(sq, occupied) & diagonal:
+            return True
+        straight = pieces[ROOK] | pieces[QUEEN]
+        return bool(straight and rook_attacks(sq, occupied) & straight)
+
+    # bitboard of the pieces of a colour and kind that attack the square
+    def attackers(self, sq: int, color: int, kind: int):
+        occupied = self.occupied[WHITE] | self.occupied[BLACK]
+        if kind == PAWN:
+            attacks = PAWN_ATTACKS[color ^ 1][sq]
+        elif kind == KNIGHT:
+            attacks = KNIGHT_ATTACKS[sq]
+        elif kind == BISHOP:
+            attacks = bishop_attacks(sq, occupied)
+        elif kind == ROOK:
+            attacks = rook_attacks(sq, occupied)
+        elif kind == QUEEN:
+            attacks = queen_attacks(sq, occupied)
+        else:
+            attacks = KING_ATTACKS[sq]
+        return attacks & self.pieces[color][kind]
+
+    def in_check(self, color: int = None):
+        color = self.side if color is None else color
+        return self.attacked(self.king_square(color), color ^ 1)
+
+    def pseudo_legal_moves(self):
+        side = self.side
+        pieces = self.pieces[side]
+        own = self.occupied[side]
+        enemy = self.occupied[side ^ 1]
+        occupied = own | enemy
+        empty = ~occupied
+        moves = []
+
+        forward = 8 if side == WHITE else -8
+        start_row = ROWS[1] if side == WHITE else ROWS[6]
+        last_row = ROWS[7] if side == WHITE else ROWS[0]
+        targets = enemy | (1 << self.ep if self.ep >= 0 else 0)
+        for sq in squares_of(pieces[PAWN]):
+            ends = PAWN_ATTACKS[side][sq] & targets
+            one = sq + forward
+            if empty >> one & 1:
+                ends |= 1 << one
+                if 1 << sq & start_row and empty >> (one + forward) & 1:
+                    ends |= 1 << (one + forward)
+            for end in squares_of(ends):
+                if 1 << end & last_row:
+                    moves.extend(sq | end << 6 | promotion << 12 for promotion in (QUEEN, ROOK, BISHOP, KNIGHT))
+                else:
+                    moves.append(sq | end << 6)
+
+        for sq in squares_of(pieces[KNIGHT]):
+            moves.extend(sq | end << 6 for end in squares_of(KNIGHT_ATTACKS[sq] & ~own))
+        for sq in squares_of(pieces[BISHOP] | pieces[QUEEN]):
+            moves.extend(sq | end << 6 for end in squares_of(bishop_attacks(sq, occupied) & ~own))
+        for sq in squares_of(pieces[ROOK] | pieces[QUEEN]):
+            moves.extend(sq | end << 6 for end in squares_of(rook_attacks(sq, occupied) & ~own))
+        king = self.king_square(side)
+        moves.extend(king | end << 6 for end in squares_of(KING_ATTACKS[king] & ~own))
+
+        if self.castling:
+            for right, start, end, between, crossed in CASTLES[side]:
+                if self.castling & right and not occupied & between and not self.attacked(start, side ^ 1) \
+                        and not any(self.attacked(sq, side ^ 1) for sq in crossed):
+                    moves.append(start | end << 6)
+        return moves
+
+    def is_legal(self, move: int):
+        side = self.side
+        undo = self.make_move(move)
+        legal = not self.attacked(self.king_square(side), side ^ 1)
+        self.unmake_move(move, undo)
+        return legal
+
+    def legal_moves(self):
+        return [move for move in self.pseudo_legal_moves() if self.is_legal(move)]
+
+    # cheaper than legal_moves when only checkmate or stalemate matters
+    def has_legal_move(self):
+        return any(self.is_legal(move) for move in self.pseudo_legal_moves())
+
+    # returns what unmake_move needs to take the move back
+    def make_move(self, move: int):
+        start, end, promotion = move & 63, move >> 6 & 63, move >> 12
+        squares = self.squares
+        piece = squares[start]
+        color, kind = divmod(piece, 6)
+        pieces = self.pieces[color]
+        key = self.key ^ CASTLING_KEYS[self.castling] ^ self._ep_key() ^ SIDE_KEY
+
+        captured, captured_sq = squares[end], end
+        if kind == PAWN and end == self.ep:
+            captured_sq = end - 8 if color == WHITE else end + 8
+            captured = squares[captured_sq]
+        undo = (captured, captured_sq, self.castling, self.ep, self.halfmove, self.key)
+        if captured != EMPTY:
+            enemy, captured_kind = divmod(captured, 6)
+            self.pieces[enemy][captured_kind] ^= 1 << captured_sq
+            self.occupied[enemy] ^= 1 << captured_sq
+            squares[captured_sq] = EMPTY
+            key ^= PIECE_KEYS[captured][captured_sq]
+
+        moved = 1 << start | 1 << end
+        pieces[kind] ^= moved
+        self.occupied[color] ^= moved
+        squares[start] = EMPTY
+        squares[end] = piece
+        key ^= PIECE_KEYS[piece][start] ^ PIECE_KEYS[piece][end]
+        if promotion:
+            pieces[PAWN] ^= 1 << end
+            pieces[promotion] |= 1 << end
+            squares[end] = color * 6 + promotion
+            key ^= PIECE_KEYS[piece][end] ^ PIECE_KEYS[color * 6 + promotion][end]
+        elif kind == KING and abs(end - start) == 2:
+            rook_start, rook_end = ROOK_CASTLE_MOVES[end]
+            rook_moved = 1 << rook_start | 1 << rook_end
+            pieces[ROOK] ^= rook_moved
+            self.occupied[color] ^= rook_moved
+            rook = squares[rook_start]
+            squares[rook_end] = rook
+            squares[rook_start] = EMPTY
+            key ^= PIECE_KEYS[rook][rook_start] ^ PIECE_KEYS[rook][rook_end]
+
+        self.ep = (start + end) // 2 if kind == PAWN and abs(end - start) == 16 else -1
+        self.castling &= CASTLING_MASK[start] & CASTLING_MASK[end]
+        self.halfmove = 0 if kind == PAWN or captured != EMPTY else self.halfmove + 1
+        if color == BLACK:
+            self.fullmove += 1
+        self.side = color ^ 1
+        self.key = key ^ CASTLING_KEYS[self.castling] ^ self._ep_key()
+        return undo
+
+    def unmake_move(self, move: int, undo: tuple):
+        start, end, promotion = move & 63, move >> 6 & 63, move >> 12
+        captured, captured_sq, self.castling, self.ep, self.halfmove, self.key = undo
+        squares = self.squares
+        color = self.side ^ 1
+        pieces = self.pieces[color]
+        self.side = color
+        if color == BLACK:
+            self.fullmove -= 1
+
+        kind = PAWN if promotion else squares[end] % 6
+        if promotion:
+            pieces[promotion] ^= 1 << end
+            pieces[PAWN] ^= 1 << end
+        elif kind == KING and abs(end - start) == 2:
+            rook_start, rook_end = ROOK_CASTLE_MOVES[end]
+            rook_moved = 1 << rook_start | 1 << rook_end
+            pieces[ROOK] ^= rook_moved
+            self.occupied[color] ^= rook_moved
+            squares[rook_start] = squares[rook_end]
+            squares[rook_end] = EMPTY
+        moved = 1 << start | 1 << end
+        pieces[kind] ^= moved
+        self.occupied[color] ^= moved
+        squares[start] = color * 6 + kind
+        squares[end] = EMPTY
+
+        if captured != EMPTY:
+            enemy, captured_kind = divmod(captured, 6)
+            self.pieces[enemy][captured_kind] |= 1 << captured_sq
+            self.occupied[enemy] |= 1 << captured_sq
+            squares[captured_sq] = captured
+
+    # only the candidate moves between the two squares are checked for legality
+    def find_move(self, start: int, end: int, promotion: str = None):
+        kind = PROMOTIONS.get((promotion or 'q').lower())
+        for move in self.pseudo_legal_moves():
+            if move & 63 == start and move >> 6 & 63 == end and move >> 12 in (0, kind) and self.is_legal(move):
+                return move
+        return None
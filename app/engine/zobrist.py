@@ -0,0 +1,24 @@
+import random
+
+# fixed seed so every worker, and every key already stored in the database, agrees on the keys
+_random = random.Random(0x5EED_C4E55)
+
+
+def _key():
+    return _random.getrandbits(64)
+
+
+# PIECE_KEYS[colour * 6 + kind][square]
+PIECE_KEYS = [[_key() for _ in range(64)] for _ in range(12)]
+SIDE_KEY = _key()
+CASTLING_KEYS = [_key() for _ in range(16)]
+EP_KEYS = [_key() for _ in range(8)]
+
+
+# postgres has no unsigned 64 bit integers, keys are stored in a bigint
+def to_signed(key: int):
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def to_unsigned(key: int):
+    return key & (1 << 64) - 1
@@ -0,0 +1,188 @@
+import argparse
+import sys
+
+from sqlalchemy import select, func, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models
+from .database import SessionLocal
+from .engine import Position
+
+# every game starts from the default board of the games table
+START = "rnbqkbnr#pppppppp#8#8#8#8#PPPPPPPP#RNBQKBNR"
+
+
+class Unreplayable(Exception):
+    pass
+
+
+# boards after each move, the steps of a game are not stored but replayed from its moves. from the first
+# move the old history arrays left unknown (None) on, the stored boards are used instead
+def replay(game_moves: list[int | None], stored: list[str | None]):
+    position = Position.from_board(START, 'w', [True] * 4)
+    steps = []
+    for ply, move in enumerate(game_moves):
+        if move is None:
+            position = None
+        if position is None:
+            steps.append(stored[ply] or (steps[-1] if steps else START))
+            continue
+        position.make_move(move)
+        steps.append(position.to_board())
+    return steps
+
+
+# move_history and steps of a game, with the packed moves they come from
+def load(db: Session, game_id: int):
+    rows = (
+        db.query(models.Move.move, models.Move.notation, models.Move.step)
+        .filter(models.Move.game_id == game_id)
+        .order_by(models.Move.ply)
+        .all()
+    )
+    game_moves = [row.move for row in rows]
+    return game_moves, [row.notation for row in rows], replay(game_moves, [row.step for row in rows])
+
+
+def count(game_id):
+    return select(func.count()).where(models.Move.game_id == game_id).scalar_subquery()
+
+
+# moves only ever get appended, rows another worker or an earlier attempt already wrote are kept.
+# the boards are only stored for games whose moves no longer replay
+def append(db: Session, game_id: int, saved: int, game_moves: list[int | None], notations: list[str],
+           steps: list[str]):
+    if len(game_moves) <= saved:
+        return
+    replayable = None not in game_moves
+    db.execute(
+        insert(models.Move)
+        .values([{"game_id": game_id, "ply": ply, "move": game_moves[ply], "notation": notations[ply],
+                  "step": None if replayable else steps[ply]}
+                 for ply in range(saved, len(game_moves))])
+        .on_conflict_do_nothing(index_elements=['game_id', 'ply'])
+    )
+
+
+# the packed moves of a game, the unknown ones worked out from the boards in steps as the old array
+# columns stored them
+def moves_of(game_moves: list[int | None], steps: list[str | None]):
+    position = Position.from_board(START, 'w', [True] * 4)
+    found = []
+    for ply, (move, step) in enumerate(zip(game_moves, steps)):
+        if move is not None:
+            position.make_move(move)
+            found.append(move)
+            continue
+        if step is None:
+            raise Unreplayable(f"move {ply} has no board")
+        after = Position.from_board(step).squares
+        changed = {sq for sq in range(64) if position.squares[sq] != after[sq]}
+        for move in position.legal_moves():
+            if move & 63 not in changed or move >> 6 & 63 not in changed:
+                continue
+            undo = position.make_move(move)
+            if position.to_board() == step:
+                break
+            position.unmake_move(move, undo)
+        else:
+            raise Unreplayable(f"move {ply} does not follow from a legal move")
+        found.append(move)
+    return found
+
+
+# games with moves still to work out, see convert
+def unconverted(db: Session, game_ids: list[int] = None):
+    query = db.query(models.Move.game_id).filter(models.Move.move.is_(None)).distinct()
+    if game_ids:
+        query = query.filter(models.Move.game_id.in_(game_ids))
+    return [game_id for (game_id,) in query.order_by(models.Move.game_id).all()]
+
+
+# after the migration to the moves table: works out the packed moves of the history copied from the old
+# arrays and drops the boards they replay to. games that do not replay keep their boards and are returned
+# with the reason, every game is committed on its own
+def convert(db: Session, game_ids: list[int] = None):
+    failed = {}
+    for game_id in unconverted(db, game_ids):
+        rows = (
+            db.query(models.Move.ply, models.Move.move, models.Move.step)
+            .filter(models.Move.game_id == game_id)
+            .order_by(models.Move.ply)
+            .all()
+        )
+        try:
+            game_moves = moves_of([row.move for row in rows], [row.step for row in rows])
+        except Unreplayable as e:
+            failed[game_id] = str(e)
+            continue
+        except (IndexError, ValueError) as e:
+            failed[game_id] = f"malformed board: {e}"
+            continue
+        for row, move in zip(rows, game_moves):
+            db.execute(
+                update(models.Move)
+                .where(models.Move.game_id == game_id, models.Move.ply == row.ply)
+                .values(move=move, step=None)
+            )
+        db.commit()
+    return failed
+
+
+# before downgrading past the moves table: stores the replayed board of every move, the old arrays are
+# filled from them
+def restore(db: Session, game_ids: list[int] = None):
+    query = db.query(models.Move.game_id).filter(models.Move.step.is_(None)).distinct()
+    if game_ids:
+        query = query.filter(models.Move.game_id.in_(game_ids))
+    for (game_id,) in query.order_by(models.Move.game_id).all():
+        steps = load(db, game_id)[2]
+        for ply, step in enumerate(steps):
+            db.execute(
+                update(models.Move)
+                .where(models.Move.game_id == game_id, models.Move.ply == ply, models.Move.step.is_(None))
+                .values(step=step)
+            )
+        db.commit()
+    return {}
+
+
+# the games whose moves do not replay to the saved board, or still have moves to convert
+def check(db: Session, game_ids: list[int] = None):
+    failed = {game_id: "moves not converted yet" for game_id in unconverted(db, game_ids)}
+    query = db.query(models.Game.id, models.Game.board).order_by(models.Game.id)
+    if game_ids:
+        query = query.filter(models.Game.id.in_(game_ids))
+    for game in query.all():
+        if game.id in failed:
+            continue
+        steps = load(db, game.id)[2]
+        if (steps[-1] if steps else START) != game.board:
+            failed[game.id] = "replayed board differs from the saved one"
+    return failed
+
+
+COMMANDS = {"convert": convert, "restore": restore, "check": check}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert and check the move history of games")
+    parser.add_argument("command", choices=COMMANDS,
+                        help="convert works out the moves the migration to the moves table copied as boards, "
+                             "restore stores the board of every move before downgrading past that migration, "
+                             "check replays the moves table against the saved boards")
+    parser.add_argument("games", nargs="*", type=int, help="ids of the games, all of them by default")
+    args = parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        failed = COMMANDS[args.command](db, args.games)
+    finally:
+        db.close()
+    for game_id, reason in failed.items():
+        print(f"game {game_id}: {reason}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,238 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable
+import asyncio
+import fcntl
+import glob
+import logging
+import os
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+
+class MoveJournal:
+    # write-behind buffer for game moves.
+    # the latest state of each game is kept in memory and a background task commits the states in batches
+    # every few milliseconds or every few moves, so only the latest state of each game has to be written.
+    # with a path, every move is also appended to local segment files as a small entry (see
+    # moves.journal_entry). the entries are written and synced on a thread of their own, all the entries
+    # that arrived meanwhile in one write, so a move never waits on the disk.
+    # every process writes to a slot of its own, path.0, path.1 and so on, locked while the process runs.
+    # a starting process takes the first free slot and the segments of every slot left behind by a process
+    # that died
+
+    def __init__(self, write: Callable[[dict[int, dict]], None],
+                 restore: Callable[[int, list[dict]], Awaitable[dict | None]] = None,
+                 path: str = '', fsync: bool = False, flush_ms: int = 200, flush_moves: int = 100):
+        # write receives {game_id: state} and runs on the journal thread
+        self.write = write
+        # restore turns the entries of a game left behind by a crash into its state
+        self.restore = restore
+        self.executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="move-journal")
+        self.file_executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="move-journal-file")
+        self.path = path
+        # the slot of this process, segments are named after it
+        self.base = ''
+        self.slot_lock = None
+        self.fsync = fsync
+        self.flush_interval = flush_ms / 1000
+        self.flush_moves = flush_moves
+        self.pending: dict[int, dict] = {}
+        # batch being written right now
+        self.inflight: dict[int, dict] = {}
+        self.moves = 0
+        self.segment = 0
+        self.file = None
+        # encoded entries waiting for the file thread
+        self.lines: list[bytes] = []
+        self.syncing: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()
+        # a flush waits for the one in progress, so once it returns every earlier move is committed
+        self.lock = asyncio.Lock()
+        self.task: asyncio.Task | None = None
+
+    def append(self, game_id: int, state: dict, entry: dict):
+        if self.file:
+            self.lines.append(orjson.dumps({"game_id": game_id, **entry}) + b'\n')
+            if self.syncing is None:
+                self.syncing = asyncio.create_task(self._sync())
+        self.pending[game_id] = state
+        self.moves += 1
+        if self.moves >= self.flush_moves:
+            self.wakeup.set()
+
+    # latest state of a game that is not committed yet
+    def get(self, game_id: int):
+        return self.pending.get(game_id) or self.inflight.get(game_id)
+
+    async def start(self):
+        if self.path:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.file_executor, self._claim)
+            await self._recover()
+            self.file = open(self._segment_path(self.segment), 'ab')
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.syncing:
+            await self.syncing
+        await self.flush()
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.slot_lock:
+            self.slot_lock.close()
+            self.slot_lock = None
+        self.executor.shutdown(wait=True)
+        self.file_executor.shutdown(wait=True)
+
+    async def flush(self):
+        async with self.lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self.pending:
+            return
+        batch, self.pending, self.moves = self.pending, {}, 0
+        self.inflight = batch
+        loop = asyncio.get_running_loop()
+        # the file thread writes in order, so the entries of this batch are in the segments before the new one
+        segment = await loop.run_in_executor(self.file_executor, self._rotate) if self.file else None
+        try:
+            await loop.run_in_executor(self.executor, self.write, batch)
+        except Exception:
+            logger.exception("Could not flush %d games, retrying on next flush", len(batch))
+            # keep the batch for the next flush, moves that arrived meanwhile are newer and win
+            for game_id, data in batch.items():
+                self.pending.setdefault(game_id, data)
+            self.moves = len(self.pending)
+            return
+        finally:
+            self.inflight = {}
+        if segment is not None:
+            await loop.run_in_executor(self.file_executor, self._discard, segment)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    # group commit: hands the entries gathered so far to the file thread, and the ones that arrive during
+    # the write to the next one
+    async def _sync(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while self.lines:
+                lines, self.lines = self.lines, []
+                await loop.run_in_executor(self.file_executor, self._write_lines, lines)
+        except Exception:
+            logger.exception("Could not write the move journal")
+        finally:
+            self.syncing = None
+
+    def _write_lines(self, lines: list[bytes]):
+        self.file.write(b''.join(lines))
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    def _segment_path(self, segment: int, base: str = None):
+        return f"{base or self.base}.{segment:08d}"
+
+    def _segments(self, base: str = None):
+        segments = []
+        for name in glob.glob(f"{glob.escape(base or self.base)}.*"):
+            suffix = name.rsplit('.', 1)[1]
+            if suffix.isdigit():
+                segments.append(int(suffix))
+        return sorted(segments)
+
+    # the lock file of a slot, locked, or None when another process holds it
+    def _lock(self, base: str):
+        lock = open(f"{base}.lock", 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        return lock
+
+    # takes the first free slot and moves the segments of the other free slots behind its own, recovery
+    # then replays them with the segments this slot already had
+    def _claim(self):
+        slot = 0
+        while self.slot_lock is None:
+            self.base = f"{self.path}.{slot}"
+            self.slot_lock = self._lock(self.base)
+            slot += 1
+        own = self._segments()
+        segment = own[-1] + 1 if own else 0
+        for name in sorted(glob.glob(f"{glob.escape(self.path)}.*.lock")):
+            base = name.removesuffix(".lock")
+            if base == self.base:
+                continue
+            lock = self._lock(base)
+            if lock is None:
+                continue
+            try:
+                for orphan in self._segments(base):
+                    os.rename(self._segment_path(orphan, base), self._segment_path(segment))
+                    segment += 1
+            finally:
+                lock.close()
+
+    # start a new segment so the ones being flushed can be deleted once they are committed.
+    # returns the last segment covered by the flush
+    def _rotate(self):
+        if self.file and self.file.tell():
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._segment_path(self.segment), 'ab')
+        return self.segment - 1
+
+    def _discard(self, upto: int):
+        if not self.path:
+            return
+        for segment in self._segments():
+            if segment <= upto:
+                os.remove(self._segment_path(segment))
+
+    def _read_segments(self):
+        segments = self._segments()
+        entries: dict[int, list[dict]] = {}
+        for segment in segments:
+            with open(self._segment_path(segment), 'rb') as file:
+                for line in file:
+                    try:
+                        entry = orjson.loads(line)
+                    except orjson.JSONDecodeError:
+                        # last line of a segment that was being written when the process died
+                        continue
+                    entries.setdefault(entry.pop('game_id'), []).append(entry)
+        return segments, entries
+
+    # replay the segments left behind by a crash, the games are flushed with the first batch
+    async def _recover(self):
+        loop = asyncio.get_running_loop()
+        segments, entries = await loop.run_in_executor(self.file_executor, self._read_segments)
+        for game_id, game_entries in entries.items():
+            state = await self.restore(game_id, game_entries)
+            if state is not None:
+                self.pending[game_id] = state
+        if segments:
+            self.segment = segments[-1] + 1
+            self.moves = len(self.pending)
+            logger.info("Recovered %d unsaved games from the move journal", len(self.pending))
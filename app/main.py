@@ -1,12 +1,18 @@
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from .routers import user, auth, sockets, game
+from .persistence import move_journal
+from .database import async_engine
+from .tokens import token_purge
+from .metrics import metrics
+from . import utils
 from fastapi.middleware.cors import CORSMiddleware
 
 # from . import models
 # from .database import engine
 # models.Base.metadata.create_all(bind=engine)
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 origins = ["*"]
 app.add_middleware(
@@ -15,6 +21,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(user.router)
@@ -26,3 +33,24 @@ app.include_router(game.router)
 @app.get("/")
 def root():
     return {"message": "Server running"}
+
+
+@app.get("/metrics")
+def get_metrics():
+    return metrics.collect()
+
+
+@app.on_event("startup")
+async def startup():
+    await move_journal.start()
+    await sockets.manager.start()
+    await token_purge.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await token_purge.close()
+    await sockets.manager.close()
+    await move_journal.close()
+    await async_engine.dispose()
+    utils.shutdown_password_pool()
@@ -0,0 +1,33 @@
+from threading import Lock
+from typing import Callable
+
+
+class Metrics:
+    # process wide counters and gauges, served as JSON by GET /metrics.
+    # gauges are callables read when the metrics are collected
+
+    def __init__(self):
+        self.values: dict[str, float] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self.lock = Lock()
+
+    def inc(self, name: str, amount: float = 1):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        with self.lock:
+            self.values[name] = value
+
+    def gauge(self, name: str, read: Callable[[], float]):
+        self.gauges[name] = read
+
+    def collect(self):
+        with self.lock:
+            values = dict(self.values)
+        for name, read in self.gauges.items():
+            values[name] = read()
+        return dict(sorted(values.items()))
+
+
+metrics = Metrics()
@@ -1,5 +1,5 @@
 from .database import Base
-from sqlalchemy import Column, Integer, String, BOOLEAN, ForeignKey, SmallInteger, ARRAY
+from sqlalchemy import Column, Integer, String, BOOLEAN, ForeignKey, SmallInteger, ARRAY, BigInteger, Index, LargeBinary
 from sqlalchemy.sql.sqltypes import TIMESTAMP
 from sqlalchemy.sql.expression import text
 from sqlalchemy.orm import relationship, query_expression, Mapped
@@ -7,34 +7,34 @@ from sqlalchemy.orm import relationship, query_expression, Mapped
 
 class User(Base):
     __tablename__ = "users"
+    # available opponents are searched by email prefix in byte order, which a "C" collation index serves
+    __table_args__ = (
+        Index('ix_users_available_email', text('email COLLATE "C"'),
+              postgresql_where=text('active_game_id IS NULL')),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     email = Column(String, nullable=False, unique=True)
     password = Column(String, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
-
-
-class Capture(Base):
-    __tablename__ = "captures"
-
-    id = Column(Integer, primary_key=True, nullable=False)
-    p = Column(SmallInteger, nullable=False, server_default='0')
-    r = Column(SmallInteger, nullable=False, server_default='0')
-    n = Column(SmallInteger, nullable=False, server_default='0')
-    b = Column(SmallInteger, nullable=False, server_default='0')
-    q = Column(SmallInteger, nullable=False, server_default='0')
-    k = Column(SmallInteger, nullable=False, server_default='0')
-    P = Column(SmallInteger, nullable=False, server_default='0')
-    R = Column(SmallInteger, nullable=False, server_default='0')
-    N = Column(SmallInteger, nullable=False, server_default='0')
-    B = Column(SmallInteger, nullable=False, server_default='0')
-    Q = Column(SmallInteger, nullable=False, server_default='0')
-    K = Column(SmallInteger, nullable=False, server_default='0')
+    # latest ongoing game of the user, null while the user is available
+    active_game_id = Column(Integer)
 
 
 class Game(Base):
     __tablename__ = "games"
+    # every game lookup is by player, one index per colour so "white = ? OR black = ?" becomes two index scans
+    __table_args__ = (
+        Index('ix_games_white_player_history', 'white_player_id',
+              'is_concluded', text('created_at DESC')),
+        Index('ix_games_black_player_history', 'black_player_id',
+              'is_concluded', text('created_at DESC')),
+        Index('ix_games_active_white_player', 'white_player_id',
+              postgresql_where=text('NOT is_concluded')),
+        Index('ix_games_active_black_player', 'black_player_id',
+              postgresql_where=text('NOT is_concluded')),
+    )
 
     id = Column(Integer, primary_key=True, nullable=False)
     white_player_id = Column(Integer, ForeignKey(User.id), nullable=False)
@@ -44,18 +44,18 @@ class Game(Base):
     active_player = Column(String, nullable=False, server_default="w")
     last_move_start = Column(ARRAY(Integer), server_default="{}")
     last_move_end = Column(ARRAY(Integer), server_default="{}")
-    move_history = Column(ARRAY(String), nullable=False, server_default="{}")
     white_king_pos = Column(ARRAY(Integer), server_default="{0,4}")
     black_king_pos = Column(ARRAY(Integer), server_default="{7,4}")
     # white queenside, white kingside, black queenside, black kingside
     castle_eligibility = Column(
         ARRAY(BOOLEAN), server_default="{TRUE,TRUE,TRUE,TRUE}")
-    capture_id = Column(Integer, ForeignKey(Capture.id),
-                        nullable=False, unique=True)
+    # pieces captured so far, counted in the order of moves.CAPTURE_PIECES
+    captures = Column(ARRAY(SmallInteger), nullable=False,
+                      server_default="{0,0,0,0,0,0,0,0,0,0,0,0}")
     is_concluded = Column(BOOLEAN, nullable=False, server_default='FALSE')
     # 1-> White #2->Black #3->Draw
     winner = Column(Integer)
-    # 1-> Checkmate #2-> StaleMate #3-> Resignation #4->Agreement
+    # 1-> Checkmate #2-> StaleMate #3-> Resignation #4->Agreement #5-> Threefold repetition
     end_reason = Column(Integer)
     created_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
@@ -64,17 +64,55 @@ class Game(Base):
     enpassant_position = Column(ARRAY(Integer), server_default="{}")
     # 1-> White offered draw #2->Black offered draw #3-> White rejected draw #4-> Black rejected draw #5-> White accepted draw #6 -> Black accepted draw
     draw = Column(Integer)
-    steps = Column(ARRAY(String), nullable=False, server_default="{}")
+    # zobrist key of the current position, and of the positions since the last irreversible move
+    position_key = Column(BigInteger, index=True)
+    position_keys = Column(ARRAY(BigInteger), nullable=False, server_default="{}")
 
     white_player = relationship("User", foreign_keys='Game.white_player_id')
     black_player = relationship("User", foreign_keys='Game.black_player_id')
-    captures = relationship("Capture", foreign_keys='Game.capture_id')
+
+
+class Move(Base):
+    __tablename__ = "moves"
+    # the history of a game, a row per move appended as the game goes on. the boards after each move
+    # are replayed from the packed moves rather than stored, see history.replay
+
+    game_id = Column(Integer, ForeignKey("games.id", ondelete="CASCADE"), primary_key=True, nullable=False)
+    ply = Column(SmallInteger, primary_key=True, nullable=False)
+    # from square | to square << 6 | promotion << 12, as the engine packs a move. null for a move copied from
+    # the old history arrays that python -m app.history convert could not work out
+    move = Column(SmallInteger, nullable=True)
+    notation = Column(String, nullable=False)
+    # the board after the move, only kept once a move of the game is null and the boards cannot be replayed
+    step = Column(String, nullable=True)
+
+
+class UserStats(Base):
+    __tablename__ = "user_stats"
+    # results of the concluded games of a user, counted when a game ends instead of on every read
+
+    user_id = Column(Integer, ForeignKey(User.id, ondelete="CASCADE"), primary_key=True, nullable=False)
+    white_won = Column(Integer, nullable=False, server_default='0')
+    white_lost = Column(Integer, nullable=False, server_default='0')
+    white_draw = Column(Integer, nullable=False, server_default='0')
+    black_won = Column(Integer, nullable=False, server_default='0')
+    black_lost = Column(Integer, nullable=False, server_default='0')
+    black_draw = Column(Integer, nullable=False, server_default='0')
+    # games of the user by end_reason
+    checkmate = Column(Integer, nullable=False, server_default='0')
+    stalemate = Column(Integer, nullable=False, server_default='0')
+    resignation = Column(Integer, nullable=False, server_default='0')
+    agreement = Column(Integer, nullable=False, server_default='0')
+    repetition = Column(Integer, nullable=False, server_default='0')
 
 
 class Tokens(Base):
     __tablename__ = "tokens"
 
     id = Column(Integer, primary_key=True, nullable=False)
-    refresh = Column(String, unique=True, nullable=False)
+    # sha-256 of the refresh token, see tokens.digest
+    refresh_hash = Column(LargeBinary(32), unique=True, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True),
                         nullable=False, server_default=text('now()'))
+    # expiry of the token, expired rows are purged by tokens.TokenPurge
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False, index=True)
@@ -0,0 +1,287 @@
+from collections import Counter
+
+from .engine import Position, WHITE, BLACK, PAWN, KING, EMPTY, BOARD_LETTERS, square, squares_of
+
+FILES = "abcdefgh"
+
+# fields of a game that make up a snapshot message (GameMoveIn without player_color)
+STATE_FIELDS = (
+    "board", "active_player", "last_move_start", "last_move_end", "move_history", "steps",
+    "white_king_pos", "black_king_pos", "enpassant_position", "castle_eligibility",
+    "checked_king", "is_concluded", "winner", "end_reason", "draw", "Capture",
+)
+# game flags relayed with every delta
+DELTA_FLAGS = ("checked_king", "is_concluded", "winner", "end_reason", "draw")
+CAPTURE_PIECES = ("p", "r", "n", "b", "q", "k", "P", "R", "N", "B", "Q", "K")
+
+# 1-> White #2->Black #3->Draw
+WHITE_WINS, BLACK_WINS, DRAW = 1, 2, 3
+# draw codes of the games table: 1/2 white/black offered, 3/4 white/black rejected, 5/6 white/black accepted.
+# odd codes belong to white, even ones to black
+DRAW_OFFER = {'w': 1, 'b': 2}
+# 1-> Checkmate #2-> StaleMate #3-> Resignation #4->Agreement #5-> Threefold repetition
+CHECKMATE, STALEMATE, RESIGNATION, AGREEMENT, REPETITION = 1, 2, 3, 4, 5
+
+
+class InvalidMove(Exception):
+    pass
+
+
+# games store the captured pieces as an array in CAPTURE_PIECES order, messages as a dict
+def captures_of(captures: list[int]):
+    return dict(zip(CAPTURE_PIECES, captures))
+
+
+def packed_captures(capture: dict):
+    return [capture[piece] for piece in CAPTURE_PIECES]
+
+
+def is_square(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2 and \
+        all(isinstance(x, int) and not isinstance(x, bool) for x in value)
+
+
+# the values a client may send, anything else is rejected before it reaches the engine or the state
+def check_delta(delta: dict):
+    if delta.get('start') is not None or delta.get('end') is not None:
+        if not is_square(delta.get('start')) or not is_square(delta.get('end')):
+            raise InvalidMove("Move needs a start and an end square")
+        if not all(0 <= x < 8 for x in (*delta['start'], *delta['end'])):
+            raise InvalidMove("Square is outside the board")
+    promotion = delta.get('promotion')
+    if promotion is not None and (not isinstance(promotion, str) or len(promotion) != 1
+                                  or promotion.lower() not in "nbrq"):
+        raise InvalidMove("Promotion must be one of n, b, r or q")
+    draw = delta.get('draw')
+    if draw is not None and (not isinstance(draw, int) or isinstance(draw, bool) or not 1 <= draw <= 6):
+        raise InvalidMove("Draw must be between 1 and 6")
+
+
+# a player only sends the draw codes of their own colour, and only answers an offer of the opponent that is
+# still open. a draw left as it is passes
+def check_draw(state: dict, delta: dict, player_color: str):
+    draw = delta.get('draw')
+    if draw is None or draw == state['draw']:
+        return
+    if draw % 2 != DRAW_OFFER[player_color] % 2:
+        raise InvalidMove(f"Draw code {draw} belongs to the other player")
+    opponent = 'b' if player_color == 'w' else 'w'
+    if draw > 2 and state['draw'] != DRAW_OFFER[opponent]:
+        raise InvalidMove("There is no draw offer to answer")
+
+
+def square_name(square: list[int]):
+    return f"{FILES[square[1]]}{square[0] + 1}"
+
+
+# standard algebraic notation of a legal move, before it is made. check and mate are added by the caller
+def san(position: Position, move: int):
+    start, end, promotion = move & 63, move >> 6 & 63, move >> 12
+    kind = position.squares[start] % 6
+    if kind == KING and abs(end - start) == 2:
+        return "O-O" if end > start else "O-O-O"
+    capture = position.squares[end] != EMPTY or (kind == PAWN and (end - start) % 8 != 0)
+    target = square_name(coordinates(end))
+    if kind == PAWN:
+        notation = f"{FILES[start % 8]}x{target}" if capture else target
+        return notation + (f"={'_NBRQ'[promotion]}" if promotion else '')
+    # the other pieces of the kind that can move there, only they are checked for legality
+    others = [other for other in squares_of(position.attackers(end, position.side, kind) & ~(1 << start))
+              if position.is_legal(other | end << 6)]
+    origin = ''
+    if others:
+        if all(other % 8 != start % 8 for other in others):
+            origin = FILES[start % 8]
+        elif all(other // 8 != start // 8 for other in others):
+            origin = str(start // 8 + 1)
+        else:
+            origin = square_name(coordinates(start))
+    return f"{'PNBRQK'[kind]}{origin}{'x' if capture else ''}{target}"
+
+
+def coordinates(sq: int):
+    return list(divmod(sq, 8))
+
+
+def position_of(state: dict):
+    return Position.from_board(state['board'], state['active_player'], state['castle_eligibility'],
+                               state['enpassant_position'])
+
+
+# position_keys holds the zobrist keys of the positions since the last capture, pawn move or loss of
+# castling rights, none of which can repeat. repetitions counts them, keyed by str(key) so the state
+# stays JSON serialisable for the journal
+def track_positions(state: dict, keys: list[int]):
+    if not keys:
+        keys = [position_of(state).key]
+    state['position_keys'] = keys
+    state['repetitions'] = {str(key): count for key, count in Counter(keys).items()}
+
+
+# applies a delta message sent by the player of the given colour to the cached state of a game and returns
+# the delta to relay. the move is checked against the legal moves of the position, and check, checkmate,
+# stalemate and threefold repetition are worked out here rather than taken from the client.
+# lists in the state are replaced rather than mutated, so a state handed to the journal stays unchanged
+def apply_delta(state: dict, delta: dict, player_color: str):
+    if state['is_concluded']:
+        raise InvalidMove("Game is already over")
+    check_delta(delta)
+    check_draw(state, delta, player_color)
+    ply = len(state['move_history'])
+    if delta.get('ply') is not None and delta['ply'] != ply:
+        raise InvalidMove(f"Expected move {ply}, got {delta['ply']}")
+    if delta.get('start') is None:
+        return apply_action(state, delta, player_color, ply)
+    if state['active_player'] != player_color:
+        raise InvalidMove("It is not your turn")
+    (fr, fc), (tr, tc) = delta['start'], delta['end']
+    start, end = square(fr, fc), square(tr, tc)
+
+    position = position_of(state)
+    move = position.find_move(start, end, delta.get('promotion'))
+    if move is None:
+        raise InvalidMove(f"{square_name([fr, fc])} to {square_name([tr, tc])} is not a legal move")
+    castling = position.castling
+    # the notation is always worked out here, whatever the client sent
+    notation = san(position, move)
+    captured = position.make_move(move)[0]
+    promotion = "_nbrq"[move >> 12] if move >> 12 else None
+
+    board = position.to_board()
+    # steps are replayed from the moves once the game is saved, so they are always the board after the move
+    step = board
+    in_check = position.in_check()
+    has_legal_move = position.has_legal_move()
+    if in_check:
+        notation += '+' if has_legal_move else '#'
+
+    state['board'] = board
+    state['active_player'] = 'w' if position.side == WHITE else 'b'
+    state['last_move_start'] = [fr, fc]
+    state['last_move_end'] = [tr, tc]
+    state['moves'] = state['moves'] + [move]
+    state['move_history'] = state['move_history'] + [notation]
+    state['steps'] = state['steps'] + [step]
+    state['white_king_pos'] = coordinates(position.king_square(WHITE))
+    state['black_king_pos'] = coordinates(position.king_square(BLACK))
+    # enpassant_position is the square the pawn passed over
+    state['enpassant_position'] = coordinates(position.ep) if position.ep >= 0 else []
+    state['castle_eligibility'] = position.castle_eligibility()
+    # checked_king holds the colour of the king in check
+    state['checked_king'] = state['active_player'] if in_check else None
+    if captured >= 0:
+        letter = BOARD_LETTERS[captured]
+        state['Capture'] = {**state['Capture'], letter: state['Capture'][letter] + 1}
+    if 'draw' in delta:
+        state['draw'] = delta['draw']
+    key = str(position.key)
+    if position.halfmove == 0 or position.castling != castling:
+        state['position_keys'] = [position.key]
+        state['repetitions'] = {key: 1}
+    else:
+        state['position_keys'] = state['position_keys'] + [position.key]
+        state['repetitions'] = {**state['repetitions'], key: state['repetitions'].get(key, 0) + 1}
+    if not has_legal_move:
+        state['is_concluded'] = True
+        if in_check:
+            state['end_reason'] = CHECKMATE
+            state['winner'] = WHITE_WINS if player_color == 'w' else BLACK_WINS
+        else:
+            state['end_reason'] = STALEMATE
+            state['winner'] = DRAW
+    elif state['repetitions'][key] >= 3:
+        state['is_concluded'] = True
+        state['end_reason'] = REPETITION
+        state['winner'] = DRAW
+
+    return relayed(state, ply, [fr, fc], [tr, tc], promotion, notation, step)
+
+
+# a message without a move: draw offers and answers, resignation and draw by agreement
+def apply_action(state: dict, delta: dict, player_color: str, ply: int):
+    # the offer the agreement accepts, or the acceptance the player already sent
+    opponent = 'b' if player_color == 'w' else 'w'
+    offered = state['draw'] in (DRAW_OFFER[opponent], DRAW_OFFER[player_color] + 4)
+    if 'draw' in delta:
+        state['draw'] = delta['draw']
+    if delta.get('is_concluded'):
+        if delta.get('end_reason') == RESIGNATION:
+            state['winner'] = BLACK_WINS if player_color == 'w' else WHITE_WINS
+        elif delta.get('end_reason') == AGREEMENT:
+            if not offered:
+                raise InvalidMove("The opponent has not offered a draw")
+            state['winner'] = DRAW
+        else:
+            raise InvalidMove("Only resignation or agreement can end the game without a move")
+        state['is_concluded'] = True
+        state['end_reason'] = delta['end_reason']
+    return relayed(state, ply, None, None, None, None, None)
+
+
+def relayed(state: dict, ply: int, start, end, promotion, notation, step):
+    out = {
+        "type": "delta",
+        "id": state['id'],
+        "ply": ply,
+        "start": start,
+        "end": end,
+        "promotion": promotion,
+        "notation": notation,
+        "step": step,
+    }
+    for flag in DELTA_FLAGS:
+        out[flag] = state[flag]
+    return out
+
+
+# older clients send the whole game after every move. work out which legal move turns the cached board
+# into the one sent, so that snapshots go through the same checks as deltas
+def snapshot_to_delta(state: dict, data: dict):
+    delta = {key: data[key] for key in ('draw', 'is_concluded', 'end_reason') if key in data}
+    if data.get('board', state['board']) == state['board']:
+        return delta
+    position = position_of(state)
+    for move in position.legal_moves():
+        undo = position.make_move(move)
+        board = position.to_board()
+        position.unmake_move(move, undo)
+        if board == data['board']:
+            break
+    else:
+        raise InvalidMove("Board does not follow from a legal move")
+    delta['start'] = coordinates(move & 63)
+    delta['end'] = coordinates(move >> 6 & 63)
+    delta['promotion'] = "_nbrq"[move >> 12] if move >> 12 else None
+    return delta
+
+
+# what the journal keeps of an accepted delta: the packed move (0 for none) and the flags the player sent.
+# entry_delta turns it back into a delta apply_delta takes
+def journal_entry(state: dict, delta: dict, player_color: str):
+    return {
+        "ply": delta['ply'],
+        "color": player_color,
+        "move": state['moves'][-1] if delta['start'] else 0,
+        "draw": delta['draw'],
+        "is_concluded": delta['is_concluded'],
+        "end_reason": delta['end_reason'],
+    }
+
+
+def entry_delta(entry: dict):
+    delta = {"ply": entry['ply'], "draw": entry['draw']}
+    if entry['move']:
+        delta['start'] = coordinates(entry['move'] & 63)
+        delta['end'] = coordinates(entry['move'] >> 6 & 63)
+        delta['promotion'] = "_nbrq"[entry['move'] >> 12] if entry['move'] >> 12 else None
+    else:
+        delta['is_concluded'] = entry['is_concluded']
+        delta['end_reason'] = entry['end_reason']
+    return delta
+
+
+def snapshot(state: dict, player_color: str):
+    data = {field: state[field] for field in STATE_FIELDS}
+    data['id'] = state['id']
+    data['player_color'] = player_color
+    return data
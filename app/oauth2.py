@@ -1,12 +1,13 @@
 from jose import JWTError, jwt
 from fastapi import Depends, status, HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import datetime, timedelta
 
 from app import models
 from . import schemas
-from .database import get_db
+from .cache import TTLCache
+from .database import get_async_db
 from .config import settings
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='login')
@@ -17,8 +18,10 @@ ALGORITHM = settings.algorithm
 ACCESS_TOKEN_EXPIRED_MINUTES = settings.access_token_expire_minutes
 REFRESH_TOKEN_EXPIRED_MINUTES = settings.refresh_token_expire_minutes
 
+user_cache = TTLCache(settings.user_cache_size, settings.user_cache_ttl_seconds)
 
-# data is of the form: {"user_id": user.id}
+
+# data is of the form: {"user_id": user.id, "email": user.email}
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRED_MINUTES)
@@ -46,7 +49,7 @@ def verify_access_token(token: str, credentials_exception):
 
         if id is None:
             raise credentials_exception
-        token_data = schemas.TokenData(id=id)
+        token_data = schemas.TokenData(id=id, email=payload.get("email"))
 
     except JWTError:
         raise credentials_exception
@@ -68,36 +71,52 @@ def verify_refresh_token(token: str, credentials_exception):
     return token_data
 
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# return user from the cache, query database based on id on a miss
+async def load_user(id: str, db: AsyncSession):
+    user = user_cache.get(int(id))
+    if user is None:
+        row = await db.get(models.User, int(id))
+        if row:
+            user = schemas.UserOut.from_orm(row)
+            user_cache.set(user.id, user)
+    return user
+
+
+# call when a user is changed or deleted
+def invalidate_user(id: int):
+    user_cache.invalidate(id)
+
+
+async def token_user(token_data: schemas.TokenData, db: AsyncSession):
+    if settings.auth_user_from_token and token_data.email:
+        return schemas.UserOut(id=token_data.id, email=token_data.email)
+    return await load_user(token_data.id, db)
+
+
+# the lookups below run on the event loop, they hold no thread while the users table is read
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials', headers={"WWW-Authenticate": "Bearer"}
     )
     token_data = verify_access_token(token, credentials_exception)
-    # query database based on id and return user
-    user = db.query(models.User).filter(
-        models.User.id == token_data.id).first()
-    return user
+    return await token_user(token_data, db)
 
 
-def get_socket_user(token: str, db: Session = Depends(get_db)):
+async def get_socket_user(token: str, db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials', headers={"WWW-Authenticate": "Bearer"}
     )
     token_data = verify_access_token(token, credentials_exception)
-    user = db.query(models.User).filter(
-        models.User.id == token_data.id).first()
-    return user
+    return await token_user(token_data, db)
 
 
-def get_refresh_user(token: str, db: Session = Depends(get_db)):
+async def get_refresh_user(token: str, db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_403_FORBIDDEN,
         detail='Could not validate credentials', headers={"WWW-Authenticate": "Bearer"}
     )
     token_data = verify_refresh_token(token, credentials_exception)
-    # query database based on id and return user
-    user = db.query(models.User).filter(
-        models.User.id == token_data.id).first()
-    return user
+    # refresh tokens only carry the id, the user has to exist to get a new access token
+    return await load_user(token_data.id, db)
@@ -0,0 +1,134 @@
+from sqlalchemy import false, select
+from sqlalchemy.orm import Session, aliased
+import logging
+
+from . import models, moves, stats, queries, history
+from .database import SessionLocal, AsyncSessionLocal
+from .config import settings
+from .journal import MoveJournal
+from .cache import GameCache
+from .engine.zobrist import to_signed, to_unsigned
+
+logger = logging.getLogger(__name__)
+
+
+# reads a live game into the state the sockets work on, together with the number of its saved moves.
+# it runs on the event loop, sockets joining a game do not wait for a thread of the threadpool
+async def load_game(game_id: int):
+    async with AsyncSessionLocal() as db:
+        white, black = aliased(models.User), aliased(models.User)
+        row = (await db.execute(
+            select(models.Game, white.email, black.email)
+            .join(white, white.id == models.Game.white_player_id)
+            .join(black, black.id == models.Game.black_player_id)
+            .where(models.Game.id == game_id)
+        )).first()
+        if not row:
+            return None
+        game, white_email, black_email = row
+        state = {field: getattr(game, field)
+                 for field in moves.STATE_FIELDS if field not in ('Capture', 'move_history', 'steps')}
+        state['moves'], state['move_history'], state['steps'] = await db.run_sync(history.load, game_id)
+        state['Capture'] = moves.captures_of(game.captures)
+        state['id'] = game.id
+        state['white_player_id'] = game.white_player_id
+        state['black_player_id'] = game.black_player_id
+        state['white_player'] = white_email
+        state['black_player'] = black_email
+        moves.track_positions(
+            state, [to_unsigned(key) for key in game.position_keys])
+        return state, len(state['moves'])
+
+
+# runs on the journal thread, so it uses its own session. all games of a batch are saved in one transaction.
+# games held by the cache are written without reading them first
+def update_moves_in_db(batch: dict[int, dict]):
+    db = SessionLocal()
+    try:
+        saved = {game_id: game_cache.saved.get(game_id) for game_id in batch}
+        unknown = [game_id for game_id, count in saved.items() if count is None]
+        if unknown:
+            rows = (
+                db.query(
+                    models.Game.id,
+                    history.count(models.Game.id).label('moves'))
+                .filter(models.Game.id.in_(unknown))
+                .all()
+            )
+            for row in rows:
+                saved[row.id] = row.moves
+        for game_id, data in batch.items():
+            if saved[game_id] is None:
+                logger.warning("Game with id %s does not exist", game_id)
+                continue
+            update_move_in_db(db, game_id, data, saved[game_id])
+        db.commit()
+        for game_id, data in batch.items():
+            if game_id in game_cache.saved:
+                game_cache.saved[game_id] = len(data['moves'])
+    finally:
+        db.close()
+
+
+def update_move_in_db(db: Session, game_id: int, data: dict, saved: int):
+    if data['is_concluded']:
+        stats.record_result(db, game_id, data)
+        queries.release_players(db, game_id, (data['white_player_id'], data['black_player_id']))
+    history.append(db, game_id, saved, data['moves'], data['move_history'], data['steps'])
+    # a state older than the saved one, flushed late by another worker, is dropped
+    newer = [history.count(game_id) <= len(data['moves'])]
+    if not data['is_concluded']:
+        newer.append(models.Game.is_concluded == false())
+    (
+        db.query(models.Game)
+        .filter(models.Game.id == game_id, *newer)
+        .update({
+            models.Game.board: data['board'],
+            models.Game.active_player: data['active_player'],
+            models.Game.last_move_start: data['last_move_start'],
+            models.Game.last_move_end: data['last_move_end'],
+            models.Game.white_king_pos: data['white_king_pos'],
+            models.Game.black_king_pos: data['black_king_pos'],
+            models.Game.enpassant_position: data['enpassant_position'],
+            models.Game.castle_eligibility: data['castle_eligibility'],
+            models.Game.checked_king: data['checked_king'],
+            models.Game.is_concluded: data['is_concluded'],
+            models.Game.winner: data['winner'],
+            models.Game.end_reason: data['end_reason'],
+            models.Game.draw: data['draw'],
+            models.Game.captures: moves.packed_captures(data['Capture']),
+            models.Game.position_key: to_signed(data['position_keys'][-1]),
+            models.Game.position_keys: [to_signed(key) for key in data['position_keys']],
+        }, synchronize_session=False)
+    )
+
+
+# a game left in the journal by a crash: its saved state with the journaled moves it does not have yet
+async def restore_game(game_id: int, entries: list[dict]):
+    loaded = await load_game(game_id)
+    if loaded is None:
+        logger.warning("Game with id %s does not exist", game_id)
+        return None
+    state, saved = loaded
+    restored = False
+    for entry in entries:
+        if entry['ply'] < saved or entry['ply'] > len(state['move_history']):
+            continue
+        try:
+            moves.apply_delta(state, moves.entry_delta(entry), entry['color'])
+        except moves.InvalidMove as e:
+            logger.warning("Skipped journaled move %s of game %s: %s", entry['ply'], game_id, e)
+            continue
+        restored = True
+    return state if restored else None
+
+
+move_journal = MoveJournal(
+    update_moves_in_db,
+    restore_game,
+    path=settings.move_journal_path,
+    fsync=settings.move_journal_fsync,
+    flush_ms=settings.move_journal_flush_ms,
+    flush_moves=settings.move_journal_flush_moves
+)
+game_cache = GameCache(move_journal, load_game)
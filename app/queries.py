@@ -0,0 +1,95 @@
+from sqlalchemy import select, insert, update, union_all, literal, false, func, bindparam, Integer, ARRAY
+from sqlalchemy.orm import Session
+from datetime import datetime
+import base64
+
+from . import models
+
+
+# ids of the games a user played, filtered by criteria. "white = ? OR black = ?" cannot use an index
+# on either column, so each colour is its own branch on its own index. the black branch skips games
+# the user played against themself, which the white branch already returned.
+# order_by and limit are applied to both branches, so a page only reads limit rows per colour
+def player_games(user_id: int, *criteria, columns=(models.Game.id,), order_by=(), limit: int = None):
+    branches = [
+        select(*columns, literal('w').label('color'))
+        .where(models.Game.white_player_id == user_id, *criteria),
+        select(*columns, literal('b').label('color'))
+        .where(models.Game.black_player_id == user_id, models.Game.white_player_id != user_id, *criteria),
+    ]
+    if order_by:
+        branches = [branch.order_by(*order_by) for branch in branches]
+    if limit is not None:
+        branches = [branch.limit(limit) for branch in branches]
+    return union_all(*branches).subquery()
+
+
+# cursors of the game history are opaque to clients, they hold the sort key of the last game of a page
+def encode_cursor(created_at: datetime, id: int):
+    return base64.urlsafe_b64encode(f"{created_at.isoformat()}|{id}".encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    created_at, id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    return datetime.fromisoformat(created_at), int(id)
+
+
+# players leave a game when it ends, a player still in another ongoing game stays busy with that one
+def release_players(db: Session, game_id: int, player_ids):
+    for user_id in set(player_ids):
+        games = player_games(user_id, models.Game.is_concluded == false())
+        (
+            db.query(models.User)
+            .filter(models.User.id == user_id, models.User.active_game_id == game_id)
+            .update({models.User.active_game_id: select(func.max(games.c.id)).scalar_subquery()},
+                    synchronize_session=False)
+        )
+
+
+# creates a game for each (white_player_id, black_player_id) pair in one statement: the pairs come in as two
+# arrays, the games are inserted from them, the players are made busy with their newest game and the new games
+# are returned with the emails of their players. pairs with a player that does not exist are left out.
+# the caller commits. built on the tables rather than the mapped classes, orm statements leave out the cte
+# of the update
+def create_games(db: Session, pairs: list[tuple[int, int]]):
+    users, game_table = models.User.__table__, models.Game.__table__
+    white, black = users.alias('white'), users.alias('black')
+    pairings = (
+        func.unnest(bindparam('white_ids', [w for w, _ in pairs], type_=ARRAY(Integer)),
+                    bindparam('black_ids', [b for _, b in pairs], type_=ARRAY(Integer)))
+        .table_valued('white_player_id', 'black_player_id')
+        .render_derived(name='pairings', with_types=False)
+    )
+    games = (
+        insert(game_table)
+        .from_select(
+            ['white_player_id', 'black_player_id'],
+            select(pairings.c.white_player_id, pairings.c.black_player_id)
+            .join(white, white.c.id == pairings.c.white_player_id)
+            .join(black, black.c.id == pairings.c.black_player_id)
+        )
+        .returning(*game_table.c)
+        .cte('new_games')
+    )
+    players = union_all(
+        select(games.c.id, games.c.white_player_id.label('user_id')),
+        select(games.c.id, games.c.black_player_id),
+    ).subquery()
+    busy = (
+        select(players.c.user_id, func.max(players.c.id).label('game_id'))
+        .group_by(players.c.user_id)
+        .subquery()
+    )
+    activate = (
+        update(users)
+        .where(users.c.id == busy.c.user_id)
+        .values(active_game_id=busy.c.game_id)
+        .cte('activate')
+    )
+    return db.execute(
+        select(games, white.c.email.label('white_player'), black.c.email.label('black_player'))
+        .join(white, white.c.id == games.c.white_player_id)
+        .join(black, black.c.id == games.c.black_player_id)
+        .order_by(games.c.id)
+        .add_cte(activate)
+    ).all()
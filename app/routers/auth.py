@@ -1,7 +1,8 @@
 from fastapi import APIRouter, Depends, status, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..database import get_db
-from .. import schemas, utils, models, oauth2
+from ..database import get_db, get_async_db
+from .. import schemas, utils, models, oauth2, tokens
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 
 router = APIRouter(tags=["Authentication"])
@@ -20,42 +21,37 @@ def login(user_credentials: OAuth2PasswordRequestForm = Depends(), db: Session =
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN, detail="Invalid Credentials")
 
-    access_token = oauth2.create_access_token(data={"user_id": user.id})
+    access_token = oauth2.create_access_token(
+        data={"user_id": user.id, "email": user.email})
     refresh_token = oauth2.create_refresh_token(data={"user_id": user.id})
 
-    token = models.Tokens()
-    token.refresh = refresh_token
-    db.add(token)
+    tokens.store(db, refresh_token)
     db.commit()
 
     return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
 
 
 @router.post("/refresh", response_model=schemas.Token)
-def refresh(payload: schemas.RefreshTokenIn, db: Session = Depends(get_db)):
-    if payload.refresh_token:
-        query = db.query(models.Tokens).filter(
-            models.Tokens.refresh == payload.refresh_token)
-        token = query.first()
-        if token:
-            try:
-                user = oauth2.get_refresh_user(token.refresh, db)
-
-            except HTTPException as error:
-                # delete the refresh token if the refresh token has expired and raise error
-                query.delete()
-                db.commit()
-                raise error
-            # create and return the access token
-            access_token = oauth2.create_access_token(
-                data={"user_id": user.id})
+async def refresh(payload: schemas.RefreshTokenIn, db: AsyncSession = Depends(get_async_db)):
+    if not payload.refresh_token:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid refresh token")
+    # the signature and expiry are checked before the lookup, so a forged or expired token costs no query and
+    # does not push stored tokens out of the refresh cache. expired tokens are deleted by the token purge
+    user = await oauth2.get_refresh_user(payload.refresh_token, db)
+    # only tokens issued at login or signup and not revoked since are accepted
+    if not user or not await tokens.is_stored(db, payload.refresh_token):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Invalid refresh token")
+    # create and return the access token
+    access_token = oauth2.create_access_token(
+        data={"user_id": user.id, "email": user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
 
 @router.post("/logout", status_code=status.HTTP_204_NO_CONTENT)
-def logout(payload: schemas.RefreshTokenIn, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def logout(payload: schemas.RefreshTokenIn, db: AsyncSession = Depends(get_async_db), current_user: int = Depends(oauth2.get_current_user)):
     # delete refresh token when user logs out
     if payload.refresh_token and current_user.id:
-        db.query(models.Tokens).filter(
-            models.Tokens.refresh == payload.refresh_token).delete()
-        db.commit()
+        await tokens.revoke(db, payload.refresh_token)
+        await db.commit()
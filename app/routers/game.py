@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from fastapi.responses import StreamingResponse
 from operator import and_, or_
-from sqlalchemy import or_, and_, func, case
+from sqlalchemy import or_, and_, case, false, tuple_, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, aliased
 from sqlalchemy.exc import SQLAlchemyError
 
 from app import schemas
-from ..database import get_db
-from .. import models, oauth2
+from ..database import get_db, get_async_db, get_read_db, get_async_read_db
+from .. import models, oauth2, moves, queries, history
+from ..persistence import game_cache
+from ..config import settings
 from typing import List
 
 router = APIRouter(
@@ -17,11 +21,28 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[schemas.GameOverview])
-def get_games_history(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def get_games_history(response: Response, cursor: str | None = None,
+                      limit: int = Query(settings.games_page_size, ge=1, le=settings.games_page_max),
+                      stream: bool = False,
+                      db: Session = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
+    # pages are read by keyset on (created_at, id), so a page costs the same wherever it is in the history.
+    # the cursor of the next page is sent in X-Next-Cursor, stream=true sends the whole history as ndjson
     try:
+        criteria = [models.Game.is_concluded == True]
+        if cursor:
+            try:
+                created_at, game_id = queries.decode_cursor(cursor)
+            except ValueError:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+            criteria.append(tuple_(models.Game.created_at, models.Game.id) < tuple_(created_at, game_id))
+        order = (models.Game.created_at.desc(), models.Game.id.desc())
         white, black = aliased(models.User), aliased(models.User)
+        games = queries.player_games(
+            current_user.id, *criteria, order_by=order, limit=None if stream else limit)
         query = (
             db.query(models.Game, white, black)
+            .join(games, games.c.id == models.Game.id)
             .join(white, white.id == models.Game.white_player_id)
             .join(black, black.id == models.Game.black_player_id)
             .with_entities(
@@ -30,43 +51,52 @@ def get_games_history(db: Session = Depends(get_db), current_user: int = Depends
                 models.Game.end_reason,
                 white.email.label('white_player'),
                 black.email.label('black_player'),
-                func.array_length(models.Game.move_history,
-                                  1).label('no_of_moves'),
+                history.count(models.Game.id).label('no_of_moves'),
                 models.Game.created_at
             )
-            .filter(
-                and_(
-                    or_(
-                        models.Game.white_player_id == current_user.id,
-                        models.Game.black_player_id == current_user.id
-                    ),
-                    models.Game.is_concluded == True
-                )
-            )
-            .order_by(models.Game.created_at.desc())
+            .order_by(*order)
         )
 
-        games = query.all()
+        if stream:
+            return StreamingResponse(stream_games(query), media_type="application/x-ndjson")
+        games = query.limit(limit).all()
+        if len(games) == limit:
+            response.headers['X-Next-Cursor'] = queries.encode_cursor(
+                games[-1].created_at, games[-1].id)
         return games
     except SQLAlchemyError as e:
         error = str(e.orig)
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail=error)
 
+
+# rows come from a server side cursor in batches, so memory stays flat however long the history is.
+# the session of the request stays open until the response is sent
+def stream_games(query):
+    for game in query.execution_options(stream_results=True).yield_per(500):
+        yield schemas.GameOverview.from_orm(game).json() + "\n"
+
 # return active game of user
 
 
 @router.get("/active", response_model=schemas.ActiveGameOut | None)
-def get_ongoing_game(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def get_ongoing_game(db: AsyncSession = Depends(get_async_db), current_user: int = Depends(oauth2.get_current_user)):
+    # a game with a player connected to this worker is served from the cache, which is ahead of the database
+    state = game_cache.for_player(current_user.id)
+    if state:
+        player_color = 'w' if state['white_player_id'] == current_user.id else 'b'
+        return {
+            **moves.snapshot(state, player_color),
+            'white_player': state['white_player'],
+            'black_player': state['black_player'],
+        }
     try:
         white, black = aliased(models.User), aliased(models.User)
+        games = queries.player_games(
+            current_user.id, models.Game.is_concluded == false())
 
-        game = (
-            db.query(models.Game)
-            .join(models.Capture, models.Game.capture_id == models.Capture.id)
-            .join(white, white.id == models.Game.white_player_id)
-            .join(black, black.id == models.Game.black_player_id)
-            .with_entities(
+        game = (await db.execute(
+            select(
                 models.Game.id,
                 models.Game.white_player_id,
                 models.Game.black_player_id,
@@ -76,8 +106,6 @@ def get_ongoing_game(db: Session = Depends(get_db), current_user: int = Depends(
                 models.Game.active_player,
                 models.Game.last_move_start,
                 models.Game.last_move_end,
-                models.Game.move_history,
-                models.Game.steps,
                 models.Game.white_king_pos,
                 models.Game.black_king_pos,
                 models.Game.enpassant_position,
@@ -87,23 +115,19 @@ def get_ongoing_game(db: Session = Depends(get_db), current_user: int = Depends(
                 models.Game.winner,
                 models.Game.end_reason,
                 models.Game.draw,
-                models.Capture,
+                models.Game.captures,
                 (case(
                     (models.Game.white_player_id == current_user.id, 'w'),
                     else_='b'
                 )).label("player_color"),
             )
-            .filter(
-                and_(
-                    models.Game.is_concluded == 'f',
-                    or_(
-                        models.Game.white_player_id == current_user.id,
-                        models.Game.black_player_id == current_user.id
-                    )
-                )
-            )
-            .first()
-        )
+            .join(games, games.c.id == models.Game.id)
+            .join(white, white.id == models.Game.white_player_id)
+            .join(black, black.id == models.Game.black_player_id)
+            .limit(1)
+        )).first()
+        if game:
+            return await db.run_sync(with_history, game)
         return game
 
     except SQLAlchemyError as e:
@@ -115,15 +139,11 @@ def get_ongoing_game(db: Session = Depends(get_db), current_user: int = Depends(
 
 
 @router.get("/{id}", response_model=schemas.ActiveGameOut)
-def get_game(id: int, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+async def get_game(id: int, db: AsyncSession = Depends(get_async_read_db), current_user: int = Depends(oauth2.get_current_user)):
     try:
         white, black = aliased(models.User), aliased(models.User)
-        game = (
-            db.query(models.Game, white, black)
-            .join(white, white.id == models.Game.white_player_id)
-            .join(black, black.id == models.Game.black_player_id)
-            .join(models.Capture, models.Game.capture_id == models.Capture.id)
-            .with_entities(
+        game = (await db.execute(
+            select(
                 models.Game.id,
                 models.Game.board,
                 white.email.label('white_player'),
@@ -137,14 +157,11 @@ def get_game(id: int, db: Session = Depends(get_db), current_user: int = Depends
                 models.Game.winner,
                 models.Game.end_reason,
                 models.Game.checked_king,
-                func.array_length(models.Game.move_history,
-                                  1).label('no_of_moves'),
+                history.count(models.Game.id).label('no_of_moves'),
                 models.Game.last_move_start,
                 models.Game.last_move_end,
-                models.Game.move_history,
-                models.Game.steps,
                 models.Game.draw,
-                models.Capture,
+                models.Game.captures,
                 models.Game.white_player_id,
                 models.Game.black_player_id,
                 (case(
@@ -152,9 +169,10 @@ def get_game(id: int, db: Session = Depends(get_db), current_user: int = Depends
                     else_='b'
                 )).label("player_color"),
             )
-            .filter(models.Game.id == id)
-            .first()
-        )
+            .join(white, white.id == models.Game.white_player_id)
+            .join(black, black.id == models.Game.black_player_id)
+            .where(models.Game.id == id)
+        )).first()
 
         if not game:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
@@ -163,7 +181,7 @@ def get_game(id: int, db: Session = Depends(get_db), current_user: int = Depends
             if current_user.id not in (game.white_player_id, game.black_player_id):
                 raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                                     detail=f"You are unauthorized to view this data")
-        return game
+        return await db.run_sync(with_history, game)
 
     except SQLAlchemyError as e:
         error = str(e.orig)
@@ -175,59 +193,57 @@ def get_game(id: int, db: Session = Depends(get_db), current_user: int = Depends
 
 @router.post("/", status_code=status.HTTP_201_CREATED, response_model=schemas.ActiveGameOut)
 def create_game(request: schemas.GameStartIn, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-    if not db.query(models.User).filter(models.User.id == request.opponent_id).first():
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                            detail=f"Opponent does not exist")
-    else:
-        try:
-            white, black = aliased(models.User), aliased(models.User)
-
-            capture = models.Capture()
-            db.add(capture)
-            db.commit()
-            game = models.Game()
-            game.black_player_id = request.opponent_id
-            game.white_player_id = current_user.id
-            game.capture_id = capture.id
-            db.add(game)
-            db.commit()
-
-            result = (
-                db.query(models.Game)
-                .join(models.Capture, models.Game.capture_id == models.Capture.id)
-                .join(white, white.id == models.Game.white_player_id)
-                .join(black, black.id == models.Game.black_player_id)
-                .with_entities(
-                    models.Game.id,
-                    models.Game.white_player_id,
-                    models.Game.black_player_id,
-                    white.email.label('white_player'),
-                    black.email.label('black_player'),
-                    models.Game.board,
-                    models.Game.active_player,
-                    models.Game.last_move_start,
-                    models.Game.last_move_end,
-                    models.Game.move_history,
-                    models.Game.steps,
-                    models.Game.white_king_pos,
-                    models.Game.black_king_pos,
-                    models.Game.enpassant_position,
-                    models.Game.castle_eligibility,
-                    models.Game.checked_king,
-                    models.Game.is_concluded,
-                    models.Game.winner,
-                    models.Game.end_reason,
-                    models.Game.draw,
-                    models.Capture,
-                    (case(
-                        (models.Game.white_player_id == current_user.id, 'w'),
-                        else_='b')).label("player_color"))
-                .filter(models.Game.id == game.id)
-                .first()
-            )
-            return result
+    # one statement inserts the game, makes both players busy with it and returns it with their emails,
+    # a new game has no moves and no captures yet
+    try:
+        games = queries.create_games(db, [(current_user.id, request.opponent_id)])
+        if not games:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Opponent does not exist")
+        db.commit()
+        return {**games[0]._mapping, 'player_color': 'w', 'Capture': moves.captures_of(games[0].captures),
+                'move_history': [], 'steps': []}
+
+    except SQLAlchemyError as e:
+        error = str(e.orig)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+
+# create the games of a round of pairings at once
+
+
+@router.post("/bulk", status_code=status.HTTP_201_CREATED, response_model=List[schemas.GameCreated])
+def create_games(request: schemas.GamesCreateIn, db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+    if len(request.pairings) > settings.games_create_max:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail=f"At most {settings.games_create_max} games can be created at once")
+    pairs = [(pairing.white_player_id, pairing.black_player_id) for pairing in request.pairings]
+    organisers = {email.strip().lower() for email in settings.game_organisers.split(',') if email.strip()}
+    if current_user.email.lower() not in organisers and any(current_user.id not in pair for pair in pairs):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="Only organisers can create games for other players")
+    try:
+        games = queries.create_games(db, pairs)
+        # either every game is created or none is
+        if len(games) < len(pairs):
+            db.rollback()
+            player_ids = {user_id for pair in pairs for user_id in pair}
+            found = {user.id for user in db.query(models.User.id).filter(models.User.id.in_(player_ids))}
+            missing = sorted(player_ids - found)
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail=f"Players {missing} do not exist")
+        db.commit()
+        return games
+
+    except SQLAlchemyError as e:
+        error = str(e.orig)
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+
 
-        except SQLAlchemyError as e:
-            error = str(e.orig)
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+# move_history and steps live in the moves table, see history.load. async endpoints call it through
+# AsyncSession.run_sync
+def with_history(db: Session, game):
+    game_moves, move_history, steps = history.load(db, game.id)
+    return {**game._mapping, 'Capture': moves.captures_of(game.captures),
+            'move_history': move_history, 'steps': steps}
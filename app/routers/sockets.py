@@ -1,110 +1,399 @@
-from fastapi import WebSocket, APIRouter, WebSocketDisconnect, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy.exc import SQLAlchemyError
-from collections import defaultdict
+from fastapi import WebSocket, APIRouter, WebSocketDisconnect, Depends, status
+from collections import defaultdict, deque
+import asyncio
+import logging
+import orjson
+from pydantic import ValidationError
 
 from app import oauth2
-from .. import schemas, models
-from ..database import get_db
+from .. import schemas, moves, wire
+from ..config import settings
+from ..metrics import metrics
+from ..persistence import game_cache, move_journal
+from ..broadcast import MemoryBroadcast, create_broadcast
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 
+# every socket message goes through these, orjson is several times faster than the json module
+# starlette's send_json and receive_json use
+def encode(message: dict):
+    return orjson.dumps(message).decode()
+
+
+def decode(text: str):
+    return orjson.loads(text)
+
+
+# next message of a socket, binary frames hold wire deltas. a message that is not one raises InvalidMove
+async def receive(websocket: WebSocket):
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+    if message.get("bytes") is not None:
+        return wire.decode(message["bytes"])
+    try:
+        data = decode(message["text"])
+    except orjson.JSONDecodeError:
+        raise moves.InvalidMove("Message is not valid JSON")
+    if not isinstance(data, dict):
+        raise moves.InvalidMove("Message must be a JSON object")
+    return data
+
+
+# only the fields that were sent, apply_delta tells an unset draw from a cleared one
+def parse_delta(data: dict):
+    try:
+        return schemas.GameDeltaIn.parse_obj(data).dict(exclude_unset=True)
+    except ValidationError as e:
+        raise moves.InvalidMove("; ".join(
+            f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors()))
+
+
+# "binary" when the client asked for the wire subprotocol
+def negotiate(websocket: WebSocket, protocol: str):
+    return "binary" if wire.SUBPROTOCOL in websocket.scope.get("subprotocols", []) else protocol
+
+
+class Connection:
+    # a socket of a game. messages are queued and written by a task of its own, so a slow client never holds
+    # up the player who moved. when the queue is full, settings.socket_backpressure decides: "drop" the oldest
+    # message, "coalesce" the queue into one snapshot of the latest state, or "disconnect" the client.
+    # a write that takes longer than the send timeout disconnects the client as well
+
+    def __init__(self, websocket: WebSocket, user_id: int, protocol: str, player_color: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.protocol = protocol
+        self.player_color = player_color
+        # None in the queue stands for a snapshot of the latest state, text and bytes are sent as they are
+        self.queue: deque[dict | str | bytes | None] = deque()
+        self.ready = asyncio.Event()
+        self.latest: dict | None = None
+        self.closed = False
+        self.task = asyncio.create_task(self._write())
+        # the close handshake, kept so it is not garbage collected before it is sent
+        self.closing: asyncio.Task | None = None
+
+    def send(self, message: dict | str | bytes, state: dict | None = None):
+        if self.closed:
+            return
+        if state is not None:
+            self.latest = state
+        # a pending snapshot is built when it is written, so it already holds this message
+        if self.queue and self.queue[-1] is None:
+            return
+        if len(self.queue) >= settings.socket_queue_size:
+            metrics.inc(f"socket_{settings.socket_backpressure}_total")
+            if settings.socket_backpressure == "disconnect":
+                self.close(status.WS_1013_TRY_AGAIN_LATER)
+                return
+            if settings.socket_backpressure == "coalesce" and self.latest is not None:
+                self.queue.clear()
+                message = None
+            else:
+                self.queue.popleft()
+        self.queue.append(message)
+        self.ready.set()
+
+    # code None stops writing to a socket that is already closed
+    def close(self, code: int | None = None):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        if code is not None:
+            self.closing = asyncio.create_task(self._close(code))
+
+    async def _write(self):
+        timeout = settings.socket_send_timeout_ms / 1000
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                message = self.queue.popleft()
+                if message is None:
+                    message = {**moves.snapshot(self.latest, self.player_color), "type": "snapshot"}
+                if isinstance(message, dict):
+                    message = wire.encode(message) if self.protocol == "binary" else encode(message)
+                if isinstance(message, bytes):
+                    sending = self.websocket.send_bytes(message)
+                else:
+                    sending = self.websocket.send_text(message)
+                try:
+                    await asyncio.wait_for(sending, timeout)
+                except asyncio.TimeoutError:
+                    metrics.inc("socket_send_timeout_total")
+                    self.close(status.WS_1013_TRY_AGAIN_LATER)
+                    return
+                except Exception:
+                    # the client went away, which each server implementation reports its own way
+                    # (websockets raises ConnectionClosed). the endpoint cleans up
+                    self.close()
+                    return
+            self.ready.clear()
+
+    async def _close(self, code: int):
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code), settings.socket_send_timeout_ms / 1000)
+        except Exception:
+            pass
+
+
 class ConnectionManager:
+    # sockets of the games on this worker. a move is applied here and relayed to the local sockets, the
+    # broadcast backend carries it to the other workers hosting the game, see receive
 
-    def __init__(self):
-        self.active_connections = defaultdict(lambda: defaultdict(WebSocket))
+    def __init__(self, broadcast: MemoryBroadcast):
+        self.active_connections: defaultdict[int, dict[int, Connection]] = defaultdict(dict)
+        # read only sockets, they receive every move of the game
+        self.spectators: defaultdict[int, set[Connection]] = defaultdict(set)
+        # the latest moves of each game as (ply, delta), spectators joining late catch up from here
+        self.recent: dict[int, deque[tuple[int, dict]]] = {}
+        # games being read again after a missed move, with the moves of other workers that arrived meanwhile
+        self.resyncing: dict[int, tuple[asyncio.Event, list[dict]]] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.broadcast = broadcast
 
-    async def connect(self, websocket: WebSocket, game_id: int, user_id: int):
-        await websocket.accept()
-        self.active_connections[game_id][user_id] = websocket
+    async def start(self):
+        await self.broadcast.start(self.receive)
 
-    def disconnect(self, game_id: int, user_id: int):
-        if game_id in self.active_connections and user_id in self.active_connections[game_id]:
-            self.active_connections[game_id].pop(user_id)
+    async def close(self):
+        await self.broadcast.close()
+
+    def hosts(self, game_id: int):
+        return game_id in self.active_connections or game_id in self.spectators
+
+    async def connect(self, websocket: WebSocket, game_id: int, user_id: int, protocol: str, player_color: str):
+        await websocket.accept(subprotocol=wire.SUBPROTOCOL if protocol == "binary" else None)
+        if not self.hosts(game_id):
+            await self.broadcast.subscribe(game_id)
+        connection = Connection(websocket, user_id, protocol, player_color)
+        self.active_connections[game_id][user_id] = connection
+        return connection
+
+    async def disconnect(self, game_id: int, connection: Connection):
+        connection.close()
+        # a user who connected again meanwhile keeps the newer socket
+        if self.active_connections.get(game_id, {}).get(connection.user_id) is connection:
+            self.active_connections[game_id].pop(connection.user_id)
             if self.active_connections[game_id] == {}:
                 self.active_connections.pop(game_id)
+                await self.leave(game_id)
 
-    async def send_move(self, game_id: int, user_id: int,  data: schemas.GameMoveIn, db: Session):
-        # change player_color before sending response
-        data['player_color'] = "b" if data['player_color'] == "w" else "w"
-        # more than 1 player is connected to the game, so send move to the other player
-        if len(self.active_connections[game_id]) > 1:
-            for user in self.active_connections[game_id]:
-                if user != user_id:
-                    await self.active_connections[game_id][user].send_json(data)
-        update_move_in_db(data, db, user_id)
+    # a spectator starts from a snapshot of the cached game, or from the moves after since when the
+    # recent moves still hold all of them
+    async def watch(self, websocket: WebSocket, game_id: int, user_id: int, protocol: str, state: dict,
+                    since: int | None):
+        await websocket.accept(subprotocol=wire.SUBPROTOCOL if protocol == "binary" else None)
+        if not self.hosts(game_id):
+            await self.broadcast.subscribe(game_id)
+        # moves made while waiting above were not relayed to this spectator
+        state = game_cache.get(game_id) or state
+        connection = Connection(websocket, user_id, protocol, None)
+        recent = self.recent.get(game_id, ())
+        ply = len(state['move_history'])
+        if since is not None and since <= ply and (since == ply or recent and recent[0][0] <= since):
+            connection.latest = state
+            for move_ply, delta in recent:
+                if move_ply >= since:
+                    connection.send(delta)
+        else:
+            connection.send({**moves.snapshot(state, None), "type": "snapshot"}, state)
+        self.spectators[game_id].add(connection)
+        return connection
 
+    async def unwatch(self, game_id: int, connection: Connection):
+        connection.close()
+        spectators = self.spectators.get(game_id)
+        if spectators is not None and connection in spectators:
+            spectators.discard(connection)
+            if not spectators:
+                self.spectators.pop(game_id)
+                await self.leave(game_id)
 
-manager = ConnectionManager()
+    async def leave(self, game_id: int):
+        if not self.hosts(game_id):
+            game_cache.evict(game_id)
+            self.recent.pop(game_id, None)
+            await self.broadcast.unsubscribe(game_id)
 
+    # data is a GameDeltaIn, or a GameMoveIn from older clients
+    async def send_move(self, game_id: int, user_id: int,  data: dict):
+        # the cache may have dropped a game that just ended, it is loaded again to answer late messages
+        cached = await game_cache.load(game_id)
+        player_color = "w" if cached['white_player_id'] == user_id else "b"
+        # moves are applied to a copy that replaces the cached state once the move is accepted
+        state = dict(cached)
+        try:
+            if data.get('type') == "delta":
+                data = parse_delta(data)
+            else:
+                # full snapshot, still sent by older clients
+                data = moves.snapshot_to_delta(state, data)
+            delta = moves.apply_delta(state, data, player_color)
+        except moves.InvalidMove as e:
+            self.reject(game_id, user_id, cached, str(e))
+            return
+        game_cache.put(game_id, state)
+        self.relay(game_id, user_id, state, delta)
+        move_journal.append(game_id, state, moves.journal_entry(state, delta, player_color))
+        await self.broadcast.publish(
+            game_id, {"type": "move", "user_id": user_id, "player_color": player_color, "delta": delta})
 
-def update_move_in_db(data: schemas.GameMoveIn, db: Session, user_id: int):
-    try:
-        game: models.Game = (
-            db.query(models.Game)
-            .filter(models.Game.id == data['id'])
-            .first()
-        )
-        capture: models.Capture = (
-            db.query(models.Capture)
-            .filter(models.Capture.id == game.capture_id)
-            .first()
-        )
-
-        if not game:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail=f"Game with id {id} does not exist")
-        if user_id not in (game.white_player_id, game.black_player_id):
-            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
-                                detail=f"You are not authorized to update game with id {id}")
-
-        game.board = data['board']
-        game.active_player = data['active_player']
-        game.last_move_start = data['last_move_start']
-        game.last_move_end = data['last_move_end']
-        game.move_history = data['move_history']
-        game.steps = data['steps']
-        game.white_king_pos = data['white_king_pos']
-        game.black_king_pos = data['black_king_pos']
-        game.enpassant_position = data['enpassant_position']
-        game.castle_eligibility = data['castle_eligibility']
-        game.checked_king = data['checked_king']
-        game.is_concluded = data['is_concluded']
-        game.winner = data['winner']
-        game.end_reason = data['end_reason']
-        game.draw = data['draw']
-
-        capture.p = data['Capture']['p']
-        capture.r = data['Capture']['r']
-        capture.n = data['Capture']['n']
-        capture.b = data['Capture']['b']
-        capture.q = data['Capture']['q']
-        capture.k = data['Capture']['k']
-        capture.P = data['Capture']['P']
-        capture.R = data['Capture']['R']
-        capture.N = data['Capture']['N']
-        capture.B = data['Capture']['B']
-        capture.Q = data['Capture']['Q']
-        capture.K = data['Capture']['K']
-
-        db.commit()
-
-    except SQLAlchemyError as e:
-        error = str(e.orig)
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST, detail=error)
+    # tells the sender why its message was refused and hands back the server state so it can resync
+    def reject(self, game_id: int, user_id: int, state: dict, detail: str):
+        connection = self.active_connections.get(game_id, {}).get(user_id)
+        if connection is not None:
+            player_color = "w" if state['white_player_id'] == user_id else "b"
+            connection.send({**moves.snapshot(state, player_color), "type": "error", "detail": detail})
 
+    # a message of another worker: a move it accepted, or a resync request or answer (see resync).
+    # a move is replayed on the cached state, which is then as far as the sending worker's, and relayed to the
+    # sockets here. only the sending worker journals the move
+    async def receive(self, game_id: int, message: dict):
+        kind = message.get('type', "move")
+        if kind == "flush":
+            if message['to'] == self.broadcast.origin:
+                await move_journal.flush()
+                await self.broadcast.publish(game_id, {"type": "flushed", "to": message['origin']})
+            return
+        if kind == "flushed":
+            if message['to'] == self.broadcast.origin and game_id in self.resyncing:
+                self.resyncing[game_id][0].set()
+            return
+        if not self.hosts(game_id):
+            return
+        if game_id in self.resyncing:
+            self.resyncing[game_id][1].append(message)
+            return
+        player_color, delta = message['player_color'], message['delta']
+        cached = await game_cache.load(game_id)
+        state = dict(cached)
+        try:
+            moves.apply_delta(state, delta, player_color)
+        except moves.InvalidMove:
+            logger.warning("Game %s is out of sync at move %s", game_id, delta['ply'])
+            self.resyncing[game_id] = (asyncio.Event(), [message])
+            task = asyncio.create_task(self.resync(game_id, message['origin']))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            return
+        game_cache.put(game_id, state)
+        self.relay(game_id, message['user_id'], state, delta)
 
+    # the cache missed a move, most likely one the sending worker has not saved yet, so the database is behind
+    # as well. the sender is asked to flush its journal and the game is read again once it answers, or after
+    # the resync timeout. the moves that arrived meanwhile are replayed on top and every socket of the game
+    # here gets a snapshot
+    async def resync(self, game_id: int, origin: str):
+        flushed, queued = self.resyncing[game_id]
+        try:
+            # unsaved moves of this worker go first, so the stale state is not read back from the journal
+            await move_journal.flush()
+            await self.broadcast.publish(game_id, {"type": "flush", "to": origin})
+            try:
+                await asyncio.wait_for(flushed.wait(), settings.resync_timeout_seconds)
+            except asyncio.TimeoutError:
+                logger.warning("Worker %s did not save game %s in time, reloading it anyway", origin, game_id)
+            game_cache.evict(game_id)
+            state = await game_cache.load(game_id)
+            if state is None:
+                return
+            for message in queued:
+                delta = message['delta']
+                if delta['ply'] < len(state['move_history']):
+                    continue
+                state = dict(state)
+                try:
+                    moves.apply_delta(state, delta, message['player_color'])
+                except moves.InvalidMove as e:
+                    logger.warning("Game %s is still out of sync at move %s: %s", game_id, delta['ply'], e)
+                    break
+            self.recent.pop(game_id, None)
+            # the last socket of the game may have gone meanwhile
+            if not self.hosts(game_id):
+                game_cache.evict(game_id)
+                return
+            game_cache.put(game_id, state)
+        except Exception:
+            logger.exception("Could not resync game %s", game_id)
+            return
+        finally:
+            self.resyncing.pop(game_id, None)
+        for connection in (*self.active_connections.get(game_id, {}).values(), *self.spectators.get(game_id, ())):
+            connection.send({**moves.snapshot(state, connection.player_color), "type": "snapshot"}, state)
+
+    # queues the move for the other player and the spectators connected here, this never waits on a socket.
+    # the delta is encoded once for all the spectators
+    def relay(self, game_id: int, user_id: int, state: dict, delta: dict):
+        for user, connection in self.active_connections.get(game_id, {}).items():
+            if user != user_id:
+                if connection.protocol in ("delta", "binary"):
+                    connection.send(delta, state)
+                else:
+                    connection.send(moves.snapshot(state, connection.player_color), state)
+        recent = self.recent.get(game_id)
+        if recent is None:
+            recent = self.recent[game_id] = deque(maxlen=settings.spectator_recent_moves)
+        recent.append((delta['ply'], delta))
+        encoded = {}
+        for connection in self.spectators.get(game_id, ()):
+            if connection.protocol not in encoded:
+                encoded[connection.protocol] = wire.encode(delta) if connection.protocol == "binary" else encode(delta)
+            connection.send(encoded[connection.protocol], state)
+
+
+manager = ConnectionManager(create_broadcast())
+
+
+# protocol "delta" receives compact move messages, anything else receives full game snapshots.
+# clients asking for the wire subprotocol send and receive binary deltas and snapshots instead, see wire.py
 @router.websocket("/ws/{game_id}")
-async def websocket_endpoint(websocket: WebSocket, game_id: int, current_user: int = Depends(oauth2.get_socket_user), db: Session = Depends(get_db)):
-    await manager.connect(websocket, game_id, current_user.id)
+async def websocket_endpoint(websocket: WebSocket, game_id: int, protocol: str = "snapshot", current_user: int = Depends(oauth2.get_socket_user)):
+    state = await game_cache.load(game_id)
+    # moves are saved later by the journal, so check once here that the user plays this game
+    if not state or current_user.id not in (state['white_player_id'], state['black_player_id']):
+        # a game nobody here plays or watches was only loaded for this check, it would go stale in the cache
+        if not manager.hosts(game_id):
+            game_cache.evict(game_id)
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    player_color = "w" if state['white_player_id'] == current_user.id else "b"
+    protocol = negotiate(websocket, protocol)
+    connection = await manager.connect(websocket, game_id, current_user.id, protocol, player_color)
     try:
         while True:
-            data = await websocket.receive_json()
-            await manager.send_move(game_id, current_user.id, data, db)
+            try:
+                data = await receive(websocket)
+            except moves.InvalidMove as e:
+                manager.reject(game_id, current_user.id, await game_cache.load(game_id), str(e))
+                continue
+            await manager.send_move(game_id, current_user.id, data)
     except WebSocketDisconnect:
-        manager.disconnect(game_id, current_user.id)
+        pass
+    finally:
+        await manager.disconnect(game_id, connection)
+
+
+# read only socket for anyone signed in. since is the number of moves the spectator already has, a spectator
+# joining late or reconnecting gets the moves after it instead of a snapshot when they are still in memory
+@router.websocket("/ws/{game_id}/spectate")
+async def spectator_endpoint(websocket: WebSocket, game_id: int, since: int | None = None, current_user: int = Depends(oauth2.get_socket_user)):
+    state = await game_cache.load(game_id)
+    if not state:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    connection = await manager.watch(websocket, game_id, current_user.id, negotiate(websocket, "delta"), state, since)
+    try:
+        # spectators cannot move, anything they send is ignored
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+    finally:
+        await manager.unwatch(game_id, connection)
 
 
 # region -------- Old versions --------
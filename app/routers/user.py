@@ -1,11 +1,12 @@
 from operator import and_, or_
 from app import oauth2
-from .. import models, schemas, utils
-from ..database import get_db
+from .. import models, schemas, utils, tokens
+from ..database import get_db, get_read_db
+from ..config import settings
 from sqlalchemy.orm import Session
-from sqlalchemy import case, or_, and_, func, select
+from sqlalchemy import and_
 from sqlalchemy.exc import SQLAlchemyError
-from fastapi import Depends, status, HTTPException, APIRouter
+from fastapi import Depends, status, HTTPException, APIRouter, Query, Response
 from app import oauth2
 from typing import List
 
@@ -35,13 +36,11 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         db.refresh(new_user)
 
         access_token = oauth2.create_access_token(
-            data={"user_id": new_user.id})
+            data={"user_id": new_user.id, "email": new_user.email})
         refresh_token = oauth2.create_refresh_token(
             data={"user_id": new_user.id})
 
-        token = models.Tokens()
-        token.refresh = refresh_token
-        db.add(token)
+        tokens.store(db, refresh_token)
         db.commit()
 
         return {"access_token": access_token, "refresh_token": refresh_token, "token_type": "bearer"}
@@ -54,39 +53,18 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 
 @router.get("/stats", response_model=List[schemas.UserStats])
-def get_user(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
+def get_user(db: Session = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
     try:
-        stats = (
-            db.query(
-                case(
-                    (models.Game.winner == 3, 'draw'),
-                    (or_(
-                        and_(
-                            models.Game.winner == 1,
-                            models.Game.white_player_id == current_user.id
-                        ),
-                        and_(
-                            models.Game.winner == 2,
-                            models.Game.black_player_id == current_user.id
-                        )
-                    ), 'won'),
-                    else_='lost'
-                ).label('result'),
-                func.count().label('count')
-            )
-            .filter(
-                and_(
-                    or_(
-                        models.Game.black_player_id == current_user.id,
-                        models.Game.white_player_id == current_user.id
-                    ),
-                    models.Game.is_concluded
-                )
-            )
-            .group_by('result')
-            .all()
-        )
-        return stats
+        # counted by stats.record_result when a game ends
+        row = db.get(models.UserStats, current_user.id)
+        if not row:
+            return []
+        stats = [
+            {"result": "won", "count": row.white_won + row.black_won},
+            {"result": "lost", "count": row.white_lost + row.black_lost},
+            {"result": "draw", "count": row.white_draw + row.black_draw},
+        ]
+        return [result for result in stats if result["count"]]
     except SQLAlchemyError as e:
         error = str(e.orig)
         raise HTTPException(
@@ -96,31 +74,30 @@ def get_user(db: Session = Depends(get_db), current_user: int = Depends(oauth2.g
 
 
 @router.get("/", response_model=List[schemas.UserOut])
-def get_all_users(db: Session = Depends(get_db), current_user: int = Depends(oauth2.get_current_user)):
-
+def get_all_users(response: Response, search: str = '', cursor: str | None = None,
+                  limit: int = Query(settings.users_page_size, ge=1, le=settings.users_page_max),
+                  db: Session = Depends(get_read_db), current_user: int = Depends(oauth2.get_current_user)):
+    # users without an ongoing game, in email order. search matches the start of the email and
+    # the email of the last user of a page is the cursor of the next one, sent in X-Next-Cursor
     try:
-        subQuery = (
-            db.query(models.User.id)
-            .distinct()
-            .join(
-                models.Game,
-                or_(
-                    models.Game.black_player_id == models.User.id,
-                    models.Game.white_player_id == models.User.id
-                ))
-            .filter(models.Game.is_concluded == 'f')
-            .subquery()
-        )
+        email = models.User.email.collate("C")
         userQuery = (
             db.query(models.User)
             .filter(
                 and_(
-                    models.User.id != current_user.id,
-                    models.User.id.not_in(subQuery)
+                    models.User.active_game_id == None,
+                    models.User.id != current_user.id
                 )
             )
         )
-        users = userQuery.all()
+        if search:
+            pattern = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            userQuery = userQuery.filter(email.like(pattern + '%', escape='\\'))
+        if cursor:
+            userQuery = userQuery.filter(email > cursor)
+        users = userQuery.order_by(email).limit(limit).all()
+        if len(users) == limit:
+            response.headers['X-Next-Cursor'] = users[-1].email
         return users
     except SQLAlchemyError as e:
         error = str(e.orig)
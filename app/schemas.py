@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, StrictBool, StrictInt, conint, conlist, constr
 from typing import Optional, List
 from datetime import datetime
 
@@ -29,6 +29,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     id: Optional[str]
+    email: Optional[str]
 
 
 class RefreshTokenIn(BaseModel):
@@ -111,6 +112,27 @@ class GameStartIn(BaseModel):
     opponent_id: int
 
 
+class GamePairing(BaseModel):
+    white_player_id: int
+    black_player_id: int
+
+
+class GamesCreateIn(BaseModel):
+    pairings: List[GamePairing]
+
+
+class GameCreated(BaseModel):
+    id: int
+    white_player_id: int
+    black_player_id: int
+    white_player: EmailStr
+    black_player: EmailStr
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
 class GameMoveIn(BaseModel):
     id: int
     board: str
@@ -156,6 +178,20 @@ class GameMoveOut(BaseModel):
         orm_mode = True
 
 
+# compact move message, the server applies it to its own copy of the game.
+# without start and end it only carries draw offers, resignation or draw by agreement.
+# the notation is worked out by the server, a notation sent along is ignored
+class GameDeltaIn(BaseModel):
+    type: str = "delta"
+    ply: Optional[StrictInt]
+    start: Optional[conlist(StrictInt, min_items=2, max_items=2)]
+    end: Optional[conlist(StrictInt, min_items=2, max_items=2)]
+    promotion: Optional[constr(strict=True, regex="^[nbrqNBRQ]$")]
+    is_concluded: Optional[StrictBool]
+    end_reason: Optional[StrictInt]
+    draw: Optional[conint(strict=True, ge=1, le=6)]
+
+
 class ActiveGameOut(GameMoveOut):
     white_player: str
     black_player: str
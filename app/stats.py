@@ -0,0 +1,110 @@
+import argparse
+import sys
+
+from sqlalchemy import select, union_all, literal, case, func, and_, or_, false, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from . import models, moves
+from .database import SessionLocal
+
+END_REASONS = {
+    moves.CHECKMATE: 'checkmate',
+    moves.STALEMATE: 'stalemate',
+    moves.RESIGNATION: 'resignation',
+    moves.AGREEMENT: 'agreement',
+    moves.REPETITION: 'repetition',
+}
+COLORS = {'w': 'white', 'b': 'black'}
+COUNTERS = [f"{color}_{result}" for color in COLORS.values()
+            for result in ('won', 'lost', 'draw')] + list(END_REASONS.values())
+
+
+def result_of(winner: int, color: str):
+    if winner == moves.DRAW:
+        return 'draw'
+    won = (winner == moves.WHITE_WINS) == (color == 'w')
+    return 'won' if won else 'lost'
+
+
+# counts a concluded game for both players. the game row is marked concluded first and only the
+# transaction that flips it counts the game, so a batch replayed from the journal is not counted twice
+def record_result(db: Session, game_id: int, data: dict):
+    concluded = (
+        db.query(models.Game)
+        .filter(models.Game.id == game_id, models.Game.is_concluded == false())
+        .update({
+            models.Game.is_concluded: True,
+            models.Game.winner: data['winner'],
+            models.Game.end_reason: data['end_reason'],
+        }, synchronize_session=False)
+    )
+    if not concluded:
+        return
+    players = [(data['white_player_id'], 'w')]
+    # a game against oneself counts once, as white, like the history does
+    if data['black_player_id'] != data['white_player_id']:
+        players.append((data['black_player_id'], 'b'))
+    for user_id, color in players:
+        counters = [f"{COLORS[color]}_{result_of(data['winner'], color)}"]
+        if data['end_reason'] in END_REASONS:
+            counters.append(END_REASONS[data['end_reason']])
+        table = models.UserStats.__table__
+        db.execute(
+            insert(table)
+            .values(user_id=user_id, **{counter: 1 for counter in counters})
+            .on_conflict_do_update(
+                index_elements=[table.c.user_id],
+                set_={counter: table.c[counter] + 1 for counter in counters})
+        )
+
+
+# rebuilds user_stats from the games table. the table is locked for the rebuild, so games concluding
+# meanwhile are counted once the rebuild is committed and neither lost nor counted twice
+def backfill(db: Session):
+    table = models.UserStats.__table__
+    db.execute(text("LOCK TABLE user_stats IN EXCLUSIVE MODE"))
+    db.execute(table.delete())
+    games = union_all(
+        select(models.Game.white_player_id.label('user_id'), literal('w').label('color'),
+               models.Game.winner, models.Game.end_reason)
+        .where(models.Game.is_concluded),
+        select(models.Game.black_player_id.label('user_id'), literal('b').label('color'),
+               models.Game.winner, models.Game.end_reason)
+        .where(models.Game.is_concluded, models.Game.black_player_id != models.Game.white_player_id),
+    ).subquery()
+
+    def count(*criteria):
+        return func.count().filter(and_(*criteria))
+
+    won = or_(and_(games.c.winner == moves.WHITE_WINS, games.c.color == 'w'),
+              and_(games.c.winner == moves.BLACK_WINS, games.c.color == 'b'))
+    result = case((games.c.winner == moves.DRAW, 'draw'), (won, 'won'), else_='lost')
+    columns = [games.c.user_id]
+    for color, name in COLORS.items():
+        for outcome in ('won', 'lost', 'draw'):
+            columns.append(count(games.c.color == color, result == outcome))
+    for end_reason in END_REASONS:
+        columns.append(count(games.c.end_reason == end_reason))
+    db.execute(
+        insert(table).from_select(
+            ['user_id', *COUNTERS],
+            select(*columns).group_by(games.c.user_id))
+    )
+    db.commit()
+    return db.query(models.UserStats).count()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rebuild the user_stats table from the concluded games")
+    parser.parse_args(argv)
+    db = SessionLocal()
+    try:
+        print(f"user_stats rebuilt for {backfill(db)} users")
+    finally:
+        db.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
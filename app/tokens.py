@@ -0,0 +1,108 @@
+from datetime import datetime, timezone
+import asyncio
+import hashlib
+import logging
+
+from jose import jwt
+from sqlalchemy import select, delete, func
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models
+from .cache import TTLCache
+from .config import settings
+from .database import AsyncSessionLocal
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# refresh tokens are looked up by the sha-256 of the token, the token itself is never stored.
+# /refresh remembers for a short while which hashes are stored (True) and which are not (False), so repeated
+# refreshes and replayed revoked tokens do not reach the database. a token revoked on another worker is
+# accepted there until its entry expires
+refresh_cache = TTLCache(settings.refresh_cache_size, settings.refresh_cache_ttl_seconds)
+
+
+def digest(token: str):
+    return hashlib.sha256(token.encode()).digest()
+
+
+# the token was just issued by oauth2.create_refresh_token, its expiry is read back without verifying it
+def store(db: Session, token: str):
+    expires_at = datetime.fromtimestamp(jwt.get_unverified_claims(token)['exp'], timezone.utc)
+    db.add(models.Tokens(refresh_hash=digest(token), expires_at=expires_at))
+
+
+async def is_stored(db: AsyncSession, token: str):
+    key = digest(token)
+    stored = refresh_cache.get(key)
+    if stored is None:
+        metrics.inc("refresh_cache_miss_total")
+        stored = (await db.execute(
+            select(models.Tokens.id).where(models.Tokens.refresh_hash == key))).first() is not None
+        refresh_cache.set(key, stored)
+    else:
+        metrics.inc("refresh_cache_hit_total")
+    return stored
+
+
+# the caller commits
+async def revoke(db: AsyncSession, token: str):
+    key = digest(token)
+    await db.execute(delete(models.Tokens).where(models.Tokens.refresh_hash == key))
+    refresh_cache.set(key, False)
+
+
+# deletes expired tokens a batch at a time, so no statement holds many row locks. rows another worker is
+# purging are skipped
+async def purge_expired(batch: int):
+    purged = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            expired = (
+                select(models.Tokens.id)
+                .where(models.Tokens.expires_at < func.now())
+                .limit(batch)
+                .with_for_update(skip_locked=True)
+                .scalar_subquery()
+            )
+            # the session cannot evaluate the subquery against the tokens it holds, there are none anyway
+            result = await db.execute(
+                delete(models.Tokens).where(models.Tokens.id.in_(expired))
+                .execution_options(synchronize_session=False))
+            await db.commit()
+        purged += result.rowcount
+        if result.rowcount < batch:
+            return purged
+
+
+class TokenPurge:
+    # background task deleting expired refresh tokens every interval seconds
+
+    def __init__(self, interval: float, batch: int):
+        self.interval = interval
+        self.batch = batch
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        while True:
+            try:
+                purged = await purge_expired(self.batch)
+                metrics.inc("refresh_tokens_purged_total", purged)
+            except Exception:
+                logger.exception("Could not purge expired refresh tokens")
+            await asyncio.sleep(self.interval)
+
+
+token_purge = TokenPurge(settings.token_purge_interval_seconds, settings.token_purge_batch)
@@ -1,9 +1,62 @@
 from passlib.context import CryptContext
+from concurrent.futures import ProcessPoolExecutor
+from fastapi import HTTPException, status
+from threading import Lock
+import multiprocessing
+import time
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from .config import settings
+from .metrics import metrics
 
-def hash(password: str):
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__rounds=settings.bcrypt_rounds)
+
+# bcrypt is slow on purpose, so it runs in its own processes. at most password_queue_limit
+# requests wait for it, the others are turned away instead of holding on to more threads
+password_pool: ProcessPoolExecutor | None = None
+password_lock = Lock()
+password_queue = 0
+
+metrics.gauge("password_queue_depth", lambda: password_queue)
+
+
+def _hash(password: str):
     return pwd_context.hash(password)
 
+
+def _verify(plain_password: str, hashed_password: str):
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _run(name: str, function, *args):
+    global password_pool, password_queue
+    with password_lock:
+        if password_queue >= settings.password_queue_limit:
+            metrics.inc("password_rejected_total")
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Server is busy, try again later")
+        if password_pool is None:
+            password_pool = ProcessPoolExecutor(max_workers=settings.password_workers,
+                                                mp_context=multiprocessing.get_context("spawn"))
+        password_queue += 1
+    started = time.perf_counter()
+    try:
+        return password_pool.submit(function, *args).result()
+    finally:
+        with password_lock:
+            password_queue -= 1
+        metrics.inc(f"password_{name}_total")
+        metrics.inc(f"password_{name}_seconds_total", time.perf_counter() - started)
+
+
+def hash(password: str):
+    return _run("hash", _hash, password)
+
+
 def verify(plain_password: str, hashed_password: str):
-    return pwd_context.verify(plain_password, hashed_password)
\ No newline at end of file
+    return _run("verify", _verify, plain_password, hashed_password)
+
+
+def shutdown_password_pool():
+    if password_pool is not None:
+        password_pool.shutdown(wait=True)
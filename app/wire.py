@@ -0,0 +1,146 @@
+import struct
+
+from .engine import Position, EMPTY, square, encode_move, decode_move
+from . import moves
+
+# websocket subprotocol of the binary messages, clients ask for it in Sec-WebSocket-Protocol
+SUBPROTOCOL = "chess.binary.v1"
+
+# first byte of every message
+DELTA, SNAPSHOT, ERROR = 1, 2, 3
+
+# delta: type, ply, move, flags, draw. move 0 carries no move (a1 to a1 is never a move)
+DELTA_FORMAT = struct.Struct(">BHHBB")
+# snapshot: type, game id, player colour, board (two squares a byte), side and castling, en passant square,
+# flags, draw, last move, captures (two counters a byte), number of moves. the moves follow as
+# length prefixed utf-8 notations and an error ends with its length prefixed detail
+SNAPSHOT_FORMAT = struct.Struct(">BIB32sBBBBH6sH")
+# draw byte of a client delta that leaves the draw offer as it is
+DRAW_UNCHANGED = 0xFF
+NO_SQUARE = 0xFF
+PROMOTIONS = "_nbrq"
+COLORS = (None, 'w', 'b')
+
+
+# flags: checked king (2 bits), is_concluded (1 bit), winner (2 bits), end_reason (3 bits)
+def pack_flags(checked_king: str | None, is_concluded: bool, winner: int | None, end_reason: int | None):
+    return COLORS.index(checked_king) | bool(is_concluded) << 2 | (winner or 0) << 3 | (end_reason or 0) << 5
+
+
+def unpack_flags(flags: int):
+    return COLORS[flags & 3], bool(flags >> 2 & 1), flags >> 3 & 3 or None, flags >> 5 or None
+
+
+def pack_move(start: list[int] | None, end: list[int] | None, promotion: str | None = None):
+    if not start or not end:
+        return 0
+    return encode_move(square(*start), square(*end), PROMOTIONS.index(promotion) if promotion else 0)
+
+
+def encode_delta(delta: dict):
+    return DELTA_FORMAT.pack(
+        DELTA, delta['ply'], pack_move(delta['start'], delta['end'], delta['promotion']),
+        pack_flags(delta['checked_king'], delta['is_concluded'], delta['winner'], delta['end_reason']),
+        delta['draw'] or 0)
+
+
+# a delta sent by a client, in the form apply_delta takes
+def decode_delta(data: bytes):
+    _, ply, move, flags, draw = DELTA_FORMAT.unpack(data)
+    _, is_concluded, _, end_reason = unpack_flags(flags)
+    delta = {"type": "delta", "ply": ply, "is_concluded": is_concluded, "end_reason": end_reason}
+    if move:
+        start, end, promotion = decode_move(move)
+        delta['start'] = moves.coordinates(start)
+        delta['end'] = moves.coordinates(end)
+        delta['promotion'] = PROMOTIONS[promotion] if promotion else None
+    if draw != DRAW_UNCHANGED:
+        delta['draw'] = draw or None
+    return delta
+
+
+def pack_nibbles(values: list[int]):
+    return bytes(values[i] | values[i + 1] << 4 for i in range(0, len(values), 2))
+
+
+def unpack_nibbles(data: bytes):
+    return [nibble for byte in data for nibble in (byte & 15, byte >> 4)]
+
+
+def encode_snapshot(data: dict):
+    position = Position.from_board(data['board'], data['active_player'], data['castle_eligibility'])
+    ep = data['enpassant_position']
+    castling = sum(1 << index for index, eligible in enumerate(data['castle_eligibility']) if eligible)
+    out = [SNAPSHOT_FORMAT.pack(
+        ERROR if data.get('type') == "error" else SNAPSHOT, data['id'], COLORS.index(data.get('player_color')),
+        pack_nibbles([piece + 1 for piece in position.squares]),
+        (data['active_player'] == 'b') | castling << 1,
+        square(*ep) if ep else NO_SQUARE,
+        pack_flags(data['checked_king'], data['is_concluded'], data['winner'], data['end_reason']),
+        data['draw'] or 0,
+        pack_move(data['last_move_start'], data['last_move_end']),
+        pack_nibbles([min(data['Capture'][piece], 15) for piece in moves.CAPTURE_PIECES]),
+        len(data['move_history']))]
+    for notation in data['move_history']:
+        text = notation.encode()[:255]
+        out.append(bytes([len(text)]) + text)
+    if data.get('type') == "error":
+        detail = data['detail'].encode()
+        out.append(struct.pack(">H", len(detail)) + detail)
+    return b"".join(out)
+
+
+# the reverse of encode_snapshot, for clients and checks. steps are not sent, king squares come from the board
+def decode_snapshot(data: bytes):
+    (kind, game_id, player_color, board, state, ep, flags, draw, last_move, captures,
+     count) = SNAPSHOT_FORMAT.unpack_from(data)
+    position = Position()
+    for sq, piece in enumerate(unpack_nibbles(board)):
+        if piece - 1 != EMPTY:
+            position.put(sq, *divmod(piece - 1, 6))
+    checked_king, is_concluded, winner, end_reason = unpack_flags(flags)
+    start, end, _ = decode_move(last_move)
+    out = {
+        "type": "error" if kind == ERROR else "snapshot",
+        "id": game_id,
+        "player_color": COLORS[player_color],
+        "board": position.to_board(),
+        "active_player": 'b' if state & 1 else 'w',
+        "castle_eligibility": [bool(state >> 1 + index & 1) for index in range(4)],
+        "enpassant_position": moves.coordinates(ep) if ep != NO_SQUARE else [],
+        "checked_king": checked_king,
+        "is_concluded": is_concluded,
+        "winner": winner,
+        "end_reason": end_reason,
+        "draw": draw or None,
+        "last_move_start": moves.coordinates(start) if last_move else [],
+        "last_move_end": moves.coordinates(end) if last_move else [],
+        "Capture": moves.captures_of(unpack_nibbles(captures)),
+        "move_history": [],
+    }
+    offset = SNAPSHOT_FORMAT.size
+    for _ in range(count):
+        length = data[offset]
+        out['move_history'].append(data[offset + 1:offset + 1 + length].decode())
+        offset += 1 + length
+    if kind == ERROR:
+        (length,) = struct.unpack_from(">H", data, offset)
+        out['detail'] = data[offset + 2:offset + 2 + length].decode()
+    return out
+
+
+def encode(message: dict):
+    if message.get('type') == "delta":
+        return encode_delta(message)
+    return encode_snapshot(message)
+
+
+# clients only send deltas in binary. a frame that is not one raises InvalidMove, which the socket answers
+# like any other refused move
+def decode(data: bytes):
+    if len(data) != DELTA_FORMAT.size or data[0] != DELTA:
+        raise moves.InvalidMove("Binary messages must be deltas")
+    _, _, move, flags, _ = DELTA_FORMAT.unpack(data)
+    if flags & 3 >= len(COLORS) or move >> 12 >= len(PROMOTIONS):
+        raise moves.InvalidMove("Malformed binary delta")
+    return decode_delta(data)
@@ -0,0 +1,126 @@
+import pytest
+
+from app import moves
+from app.engine import Position
+from app.history import START
+
+
+def new_game():
+    state = {
+        "id": 1, "board": START, "active_player": "w", "last_move_start": [], "last_move_end": [],
+        "moves": [], "move_history": [], "steps": [], "white_king_pos": [0, 4], "black_king_pos": [7, 4],
+        "enpassant_position": [], "castle_eligibility": [True] * 4, "checked_king": None,
+        "is_concluded": False, "winner": None, "end_reason": None, "draw": None,
+        "Capture": {piece: 0 for piece in moves.CAPTURE_PIECES},
+    }
+    moves.track_positions(state, [])
+    return state
+
+
+def play(state: dict, *squares):
+    for ply, (start, end) in enumerate(squares):
+        moves.apply_delta(state, {"start": start, "end": end}, "w" if ply % 2 == 0 else "b")
+    return state
+
+
+def test_move():
+    state = new_game()
+    delta = moves.apply_delta(state, {"start": [1, 4], "end": [3, 4]}, "w")
+    assert delta["notation"] == "e4"
+    assert state["active_player"] == "b"
+    assert state["move_history"] == ["e4"]
+
+
+def test_fools_mate():
+    state = play(new_game(), ([1, 5], [2, 5]), ([6, 4], [4, 4]), ([1, 6], [3, 6]), ([7, 3], [3, 7]))
+    assert state["move_history"][-1] == "Qh4#"
+    assert state["is_concluded"]
+    assert state["end_reason"] == moves.CHECKMATE
+    assert state["winner"] == moves.BLACK_WINS
+
+
+@pytest.mark.parametrize("delta, detail", [
+    ({"start": "ab", "end": "cd"}, "start and an end"),
+    ({"start": [1, 4], "end": [3, 4], "promotion": 5}, "Promotion"),
+    ({"start": [1, 4], "end": [8, 4]}, "outside the board"),
+    ({"start": [1, 4], "end": [4, 4]}, "not a legal move"),
+    ({"draw": 7}, "between 1 and 6"),
+])
+def test_invalid(delta, detail):
+    with pytest.raises(moves.InvalidMove, match=detail):
+        moves.apply_delta(new_game(), delta, "w")
+
+
+def test_not_your_turn():
+    with pytest.raises(moves.InvalidMove, match="not your turn"):
+        moves.apply_delta(new_game(), {"start": [6, 4], "end": [4, 4]}, "b")
+
+
+def test_draw_offer_and_agreement():
+    state = new_game()
+    moves.apply_delta(state, {"draw": 1}, "w")
+    delta = moves.apply_delta(state, {"draw": 6, "is_concluded": True, "end_reason": moves.AGREEMENT}, "b")
+    assert delta["is_concluded"]
+    assert state["winner"] == moves.DRAW
+    assert state["end_reason"] == moves.AGREEMENT
+
+
+def test_agreement_after_acceptance():
+    state = new_game()
+    moves.apply_delta(state, {"draw": 2}, "b")
+    moves.apply_delta(state, {"draw": 5}, "w")
+    moves.apply_delta(state, {"is_concluded": True, "end_reason": moves.AGREEMENT}, "w")
+    assert state["winner"] == moves.DRAW
+
+
+@pytest.mark.parametrize("draw", [1, 3, 5])
+def test_draw_code_of_the_other_player(draw):
+    with pytest.raises(moves.InvalidMove, match="other player"):
+        moves.apply_delta(new_game(), {"draw": draw}, "b")
+
+
+@pytest.mark.parametrize("draw, color", [(5, "w"), (6, "b"), (4, "b")])
+def test_answer_without_offer(draw, color):
+    with pytest.raises(moves.InvalidMove, match="no draw offer"):
+        moves.apply_delta(new_game(), {"draw": draw}, color)
+
+
+def test_answer_own_offer():
+    state = new_game()
+    moves.apply_delta(state, {"draw": 1}, "w")
+    with pytest.raises(moves.InvalidMove, match="no draw offer"):
+        moves.apply_delta(state, {"draw": 5}, "w")
+
+
+def test_agreement_without_offer():
+    with pytest.raises(moves.InvalidMove, match="not offered a draw"):
+        moves.apply_delta(new_game(), {"is_concluded": True, "end_reason": moves.AGREEMENT}, "b")
+
+
+def test_agreement_to_own_offer():
+    state = new_game()
+    moves.apply_delta(state, {"draw": 2}, "b")
+    with pytest.raises(moves.InvalidMove, match="not offered a draw"):
+        moves.apply_delta(state, {"is_concluded": True, "end_reason": moves.AGREEMENT}, "b")
+
+
+def test_resignation():
+    state = new_game()
+    moves.apply_delta(state, {"is_concluded": True, "end_reason": moves.RESIGNATION}, "w")
+    assert state["winner"] == moves.BLACK_WINS
+
+
+@pytest.mark.parametrize("fen, start, end, promotion, notation", [
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", 4, 6, None, "O-O"),
+    ("r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1", 4, 2, None, "O-O-O"),
+    ("4k3/8/8/8/8/8/8/R3K2R w - - 0 1", 0, 3, None, "Rd1"),
+    ("4k3/8/8/8/R7/8/8/R3K3 w - - 0 1", 0, 8, None, "R1a2"),
+    ("4k3/8/8/8/8/2N1N3/8/4K3 w - - 0 1", 18, 35, None, "Ncd5"),
+    # the other knight is pinned to the king, so it does not count
+    ("4k3/8/8/8/4r3/2N1N3/8/4K3 w - - 0 1", 18, 35, None, "Nd5"),
+    ("4k3/1P6/8/3pP3/8/8/8/4K3 w - d6 0 1", 36, 43, None, "exd6"),
+    ("2r1k3/1P6/8/8/8/8/8/4K3 w - - 0 1", 49, 58, "n", "bxc8=N"),
+])
+def test_san(fen, start, end, promotion, notation):
+    position = Position.from_fen(fen)
+    assert moves.san(position, position.find_move(start, end, promotion)) == notation
@@ -0,0 +1,25 @@
+import pytest
+
+from app.engine import Position
+from app.engine.perft import POSITIONS, perft
+
+# every depth of the standard positions small enough to run on each test run
+SHALLOW = [
+    (name, depth, nodes)
+    for name, (fen, counts) in POSITIONS.items()
+    for depth, nodes in enumerate(counts, 1)
+    if nodes <= 10000
+]
+
+
+@pytest.mark.parametrize("name, depth, nodes", SHALLOW)
+def test_perft(name, depth, nodes):
+    assert perft(Position.from_fen(POSITIONS[name][0]), depth) == nodes
+
+
+# move generator speed, run with pytest --benchmark-only
+@pytest.mark.parametrize("name", ["start", "kiwipete"])
+def test_perft_speed(benchmark, name):
+    fen, counts = POSITIONS[name]
+    position = Position.from_fen(fen)
+    assert benchmark(perft, position, 2) == counts[1]
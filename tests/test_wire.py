@@ -0,0 +1,75 @@
+import pytest
+
+from app import moves, wire
+from .test_moves import new_game, play
+
+
+def played():
+    state = play(new_game(), ([1, 4], [3, 4]), ([6, 3], [4, 3]), ([3, 4], [4, 3]), ([7, 3], [4, 3]))
+    state.update(id=7, white_player_id=1, black_player_id=2)
+    return state
+
+
+def test_delta_round_trip():
+    state = new_game()
+    delta = moves.apply_delta(state, {"start": [1, 4], "end": [3, 4], "draw": 1}, "w")
+    data = wire.encode(delta)
+    assert len(data) == wire.DELTA_FORMAT.size
+    assert wire.decode(data) == {
+        "type": "delta", "ply": 0, "is_concluded": False, "end_reason": None,
+        "start": [1, 4], "end": [3, 4], "promotion": None, "draw": 1,
+    }
+
+
+def test_delta_flags():
+    state = play(new_game(), ([1, 5], [2, 5]), ([6, 4], [4, 4]), ([1, 6], [3, 6]))
+    delta = moves.apply_delta(state, {"start": [7, 3], "end": [3, 7]}, "b")
+    assert wire.unpack_flags(wire.encode_delta(delta)[5]) == ('w', True, moves.BLACK_WINS, moves.CHECKMATE)
+
+
+def test_promotion_round_trip():
+    data = wire.DELTA_FORMAT.pack(wire.DELTA, 3, wire.pack_move([6, 1], [7, 2], "n"), 0, wire.DRAW_UNCHANGED)
+    delta = wire.decode(data)
+    assert (delta["start"], delta["end"], delta["promotion"]) == ([6, 1], [7, 2], "n")
+    assert "draw" not in delta
+
+
+def test_action_round_trip():
+    data = wire.DELTA_FORMAT.pack(
+        wire.DELTA, 4, 0, wire.pack_flags(None, True, None, moves.RESIGNATION), wire.DRAW_UNCHANGED)
+    assert wire.decode(data) == {"type": "delta", "ply": 4, "is_concluded": True, "end_reason": moves.RESIGNATION}
+
+
+def test_snapshot_round_trip():
+    state = played()
+    snapshot = {**moves.snapshot(state, "b"), "type": "snapshot"}
+    decoded = wire.decode_snapshot(wire.encode(snapshot))
+    for field in ("id", "player_color", "board", "active_player", "castle_eligibility", "enpassant_position",
+                  "checked_king", "is_concluded", "winner", "end_reason", "draw", "last_move_start",
+                  "last_move_end", "Capture", "move_history"):
+        assert decoded[field] == snapshot[field], field
+    assert decoded["type"] == "snapshot"
+    assert decoded["move_history"] == ["e4", "d5", "exd5", "Qxd5"]
+
+
+def test_error_round_trip():
+    error = {**moves.snapshot(played(), "w"), "type": "error", "detail": "a1 to a6 is not a legal move"}
+    decoded = wire.decode_snapshot(wire.encode(error))
+    assert decoded["type"] == "error"
+    assert decoded["detail"] == "a1 to a6 is not a legal move"
+    assert decoded["board"] == error["board"]
+
+
+@pytest.mark.parametrize("frame", [
+    b"",
+    b"\x01\x00",
+    # a snapshot is never sent by a client
+    bytes([wire.SNAPSHOT]) + bytes(wire.DELTA_FORMAT.size - 1),
+    # checked king colour 3 does not exist
+    wire.DELTA_FORMAT.pack(wire.DELTA, 0, wire.pack_move([1, 4], [3, 4]), 3, wire.DRAW_UNCHANGED),
+    # promotion 7 does not exist
+    wire.DELTA_FORMAT.pack(wire.DELTA, 0, wire.pack_move([6, 1], [7, 1]) | 7 << 12, 0, wire.DRAW_UNCHANGED),
+])
+def test_malformed_frames(frame):
+    with pytest.raises(moves.InvalidMove):
+        wire.decode(frame)